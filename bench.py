@@ -0,0 +1,222 @@
+# Written by Dr Daniel Buscombe, Marda Science LLC
+#
+# MIT License
+#
+# Copyright (c) 2020-22, Marda Science LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from dgs import *
+from dgs import __version__
+import os, glob
+import sys, getopt
+import json, subprocess
+from datetime import datetime
+import pandas as pd
+from scipy import ndimage
+
+STAGES = ['read', 'standardize', 'denoise', 'cwt', 'stats', 'total']
+REFERENCE = 'bench_reference.json'
+
+#================================================================
+def bench_cases(sets=('sand', 'gravel', 'synthetic'), sizes=(2, 4)):
+   """
+   the benchmark images as (set, name, image), where image is a file name
+   or, for the synthetic set, the gravel image upscaled by each factor in
+   sizes (cubic interpolation), as a float array. Repeating pixels instead
+   would leave no pixel-level detail, so the f=1 runs would not denoise
+   """
+   cases = []
+   if 'sand' in sets:
+      cases += [('sand', f.split(os.sep)[-1], f) for f in sorted(glob.glob('data'+os.sep+'IMG_*'))]
+   if 'gravel' in sets:
+      cases += [('gravel', f.split(os.sep)[-1], f) for f in sorted(glob.glob('data'+os.sep+'Cal_*.tif'))]
+   if 'synthetic' in sets:
+      for f in sorted(glob.glob('data'+os.sep+'Cal_*.tif')):
+         im = imread(f)
+         for k in sizes:
+            cases.append(('synthetic', f.split(os.sep)[-1]+' x'+str(k), ndimage.zoom(im.astype(float), (k, k, 1)[:im.ndim], order=3)))
+   return cases
+
+#================================================================
+def bench(cases, maxscales=(6, 10), filters=(0, 1), engine='fft', repeats=1, reference=None, rtol=1e-6):
+   """
+   times each stage of dgs (median of repeats, in seconds) for every case
+   at every maxscale and filter, and checks d50 and the percentiles
+   against the reference dict (see write_reference). Returns a DataFrame
+   with one row per run; 'ok' is False where the percentiles differ from
+   the reference by more than rtol, and None where there is no reference
+   """
+   rows = []
+   for set_, name, image in cases:
+      pixels = int(np.prod((imread(image) if isinstance(image, str) else image).shape[:2]))
+      for maxscale in maxscales:
+         for f in filters:
+            laps = []
+            for k in range(repeats):
+               prof = StageProfiler()
+               if isinstance(image, str):
+                  res = dgs(image, 1, maxscale, 0, 0, f, engine, profile=prof)
+               else:
+                  res = dgs_array(image, 1, maxscale, 0, 0, f, engine, profile=prof)
+               laps.append(prof.records[0])
+
+            row = {'set': set_, 'image': name, 'pixels': pixels, 'maxscale': maxscale, 'f': f, 'engine': engine}
+            for stage in STAGES:
+               row[stage] = np.median([lap.get(stage, 0) for lap in laps])
+            row['d50'] = res['percentile_values'][5]
+
+            key = '|'.join((name, str(maxscale), str(f), engine))
+            if reference is not None and key in reference:
+               ref = np.array(reference[key]['percentile_values'])
+               row['max rel diff'] = np.max(np.abs(res['percentile_values'] - ref)/np.abs(ref))
+               row['ok'] = bool(row['max rel diff'] <= rtol)
+            else:
+               row['max rel diff'] = np.nan
+               row['ok'] = None
+            row['percentile_values'] = res['percentile_values'].tolist()
+            rows.append(row)
+            print('%s maxscale=%i f=%i: %.3fs, d50=%.4f %s' % (name, maxscale, f, row['total'], row['d50'],
+                  '' if row['ok'] is None else 'ok' if row['ok'] else 'CHANGED (%.2e)' % row['max rel diff']))
+   return pd.DataFrame(rows)
+
+#================================================================
+def throughput(df):
+   """
+   images per second of each set, filter and maxscale, from the end-to-end times
+   """
+   g = df.groupby(['set', 'maxscale', 'f'])['total']
+   return (g.count()/g.sum()).rename('images/s')
+
+#================================================================
+def write_reference(df, path=REFERENCE):
+   """
+   stores the percentiles of every run in df as the reference outputs,
+   keeping entries for runs not in df
+   """
+   reference = {}
+   if os.path.exists(path):
+      with open(path) as fid:
+         reference = json.load(fid)
+   for row in df.itertuples(index=False):
+      key = '|'.join((row.image, str(row.maxscale), str(row.f), row.engine))
+      reference[key] = {'d50': row.d50, 'percentile_values': row.percentile_values, 'version': __version__}
+   with open(path, 'w') as fid:
+      json.dump(reference, fid, indent=1, sort_keys=True)
+
+#================================================================
+def compare(df, previous):
+   """
+   ratio of each run's stage times to those in the DataFrame previous
+   (above 1 is slower), for the runs in both
+   """
+   keys = ['image', 'maxscale', 'f', 'engine']
+   both = df.merge(previous, on=keys, suffixes=('', ' before'))
+   out = both[keys].copy()
+   for stage in STAGES:
+      out[stage] = both[stage]/both[stage+' before']
+   return out
+
+#================================================================
+def commit():
+   """
+   the current git commit, with -dirty if there are uncommitted changes
+   """
+   try:
+      rev = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+      dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], stderr=subprocess.DEVNULL)
+      return rev + ('-dirty' if dirty else '')
+   except (OSError, subprocess.CalledProcessError):
+      return 'unknown'
+
+#====================================
+def usage():
+   print('python bench.py {-s sets (comma separated: sand, gravel, synthetic)} {-m maxscales (comma separated)} {-f filters (comma separated, 0 and/or 1)} {-z synthetic upscaling factors (comma separated)} {-e engine (pywt or fft)} {-n repeats} {-o output folder} {-p previous results csv to compare with} {-t relative tolerance} {-u update the reference outputs}')
+
+#====================================
+if __name__ == '__main__':
+
+   argv = sys.argv[1:]
+   try:
+      opts, args = getopt.getopt(argv,"hus:m:f:z:e:n:o:p:t:")
+   except getopt.GetoptError:
+      usage()
+      sys.exit(2)
+
+   sets = ['sand', 'gravel', 'synthetic']; maxscales = [6, 10]; filters = [0, 1]; sizes = [2, 4]
+   engine = 'fft'; repeats = 1; outdir = 'bench_results'; previous = None; rtol = 1e-6; update = False
+   for opt, arg in opts:
+      if opt == '-h':
+         usage()
+         print('Example usage: python bench.py')
+         print('Example usage: python bench.py -s gravel,synthetic -m 10 -f 0 -n 3')
+         print('Example usage: python bench.py -u')
+         sys.exit()
+      elif opt in ("-s"):
+         sets = arg.split(',')
+      elif opt in ("-m"):
+         maxscales = [int(a) for a in arg.split(',')]
+      elif opt in ("-f"):
+         filters = [int(a) for a in arg.split(',')]
+      elif opt in ("-z"):
+         sizes = [int(a) for a in arg.split(',')]
+      elif opt in ("-e"):
+         engine = arg
+      elif opt in ("-n"):
+         repeats = int(arg)
+      elif opt in ("-o"):
+         outdir = arg
+      elif opt in ("-p"):
+         previous = arg
+      elif opt in ("-t"):
+         rtol = float(arg)
+      elif opt in ("-u"):
+         update = True
+
+   os.makedirs(outdir, exist_ok=True)
+   if previous is None:
+      # compare with the last run saved
+      runs = sorted(glob.glob(outdir+os.sep+'bench_*.csv'))
+      previous = runs[-1] if runs else None
+
+   reference = None
+   if os.path.exists(REFERENCE) and not update:
+      with open(REFERENCE) as fid:
+         reference = json.load(fid)
+
+   label = commit()
+   print('pydgs '+__version__+', commit '+label+', engine='+engine+', '+str(os.cpu_count())+' cores')
+   df = bench(bench_cases(sets, sizes), maxscales, filters, engine, repeats, reference, rtol)
+   df.insert(0, 'commit', label)
+
+   print(throughput(df))
+   path = outdir+os.sep+'bench_'+datetime.now().strftime("%Y-%m-%d-%H-%M")+'_'+label+'.csv'
+   df.drop(columns='percentile_values').to_csv(path, index=False)
+   print('results written to '+path)
+
+   if previous:
+      print('time relative to '+previous+' (above 1 is slower):')
+      print(compare(df, pd.read_csv(previous)).to_string(index=False))
+
+   if update:
+      write_reference(df)
+      print('reference outputs updated in '+REFERENCE)
+   elif df['ok'].eq(False).any():
+      print('percentiles changed for %i runs' % df['ok'].eq(False).sum())
+      sys.exit(1)
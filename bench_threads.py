@@ -0,0 +1,92 @@
+# Written by Dr Daniel Buscombe, Marda Science LLC
+#
+# MIT License
+#
+# Copyright (c) 2020-22, Marda Science LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from dgs import *
+import os, glob
+import sys, getopt
+import time
+import pandas as pd
+
+#================================================================
+def bench_threads(files, threads, maxscale=10, engine='fft', repeats=3):
+   """
+   single-image latency of dgs (median of repeats, in seconds) for each
+   image in files at each number of threads, as a DataFrame of images
+   (rows) versus threads (columns). Each image is decoded once beforehand,
+   so only the analysis is timed
+   """
+   out = {}
+   for file in files:
+      im = imread(file)
+      # warm up (filter banks, thread pool start-up)
+      ref = dgs_array(im, 1, maxscale, 0, 0, 0, engine)
+
+      times = []
+      for t in threads:
+         laps = []
+         for k in range(repeats):
+            start = time.perf_counter()
+            res = dgs_array(im, 1, maxscale, 0, 0, 0, engine, threads=t)
+            laps.append(time.perf_counter() - start)
+         # threads never change the answer
+         if not all(np.array_equal(ref[key], res[key]) for key in ref):
+            raise RuntimeError('threads=%i changed the result for %s' % (t, file))
+         times.append(np.median(laps))
+      out[file.split(os.sep)[-1]] = times
+      print(file.split(os.sep)[-1]+': '+', '.join('%i: %.3fs' % (t, s) for t, s in zip(threads, times)))
+
+   return pd.DataFrame.from_dict(out, orient='index', columns=threads)
+
+#====================================
+if __name__ == '__main__':
+
+   argv = sys.argv[1:]
+   try:
+      opts, args = getopt.getopt(argv,"h:e:m:t:")
+   except getopt.GetoptError:
+      print('python bench_threads.py {-e engine (pywt or fft)} {-m maxscale (integer)} {-t largest number of threads (integer)}')
+      sys.exit(2)
+
+   engine = 'fft'; maxscale = 10; nthreads = max(4, os.cpu_count() or 1)
+   for opt, arg in opts:
+      if opt == '-h':
+         print('python bench_threads.py {-e engine (pywt or fft)} {-m maxscale (integer)} {-t largest number of threads (integer)}')
+         print('Example usage: python bench_threads.py -e pywt -t 8')
+         sys.exit()
+      elif opt in ("-e"):
+         engine = arg
+      elif opt in ("-m"):
+         maxscale = int(arg)
+      elif opt in ("-t"):
+         nthreads = int(arg)
+
+   threads = [1]
+   while threads[-1]*2 <= nthreads:
+      threads.append(threads[-1]*2)
+
+   files = sorted(glob.glob('data'+os.sep+'*.JPG') + glob.glob('data'+os.sep+'*.jpg') + glob.glob('data'+os.sep+'*.tif'))
+   print('engine='+engine+', maxscale='+str(maxscale)+', '+str(os.cpu_count())+' cores')
+   df = bench_threads(files, threads, maxscale, engine)
+   print(df)
+   df.to_csv('demo_results/bench_threads_'+engine+'.csv')
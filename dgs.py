@@ -48,41 +48,912 @@ For more information visit https://github.com/dbuscombe-usgs/pyDGS
 # SOFTWARE.
 
 import numpy as np
-import sys, os
+import os, io, glob
+import hashlib, json, tempfile, platform
+import time, tracemalloc, logging, warnings
+from contextlib import contextmanager
+import imageio
 from imageio import imread
 import pywt
 from tqdm import tqdm
-from skimage.restoration import denoise_wavelet, estimate_sigma
-from functools import partial
-# rescale_sigma=True required to silence deprecation warnings
-_denoise_wavelet = partial(denoise_wavelet, rescale_sigma=True)
+from collections import OrderedDict, deque
+import threading, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
 import scipy.stats as stats
+from scipy import fft as sp_fft
+
+__version__ = '4.3'
+
+# maximum size (bytes) of the working arrays of the fft engine (see _cwt_costs)
+_FFT_BLOCK_BYTES = 2**27
+
+# =========================================================
+def _block_shape(nrows, nscales, per, max_bytes, row=0):
+    """
+    (rows, scales) in each block of a transform that needs per bytes of
+    working arrays for every row and scale, plus row bytes for every row,
+    so that a block stays under max_bytes (but holds at least one row and
+    scale). Whole rows are kept together where the budget allows
+    """
+    ns = int(min(nscales, max(1, (max_bytes // nrows - row) // per)))
+    nr = int(min(nrows, max(1, max_bytes // (per * ns + row))))
+    return nr, ns
+
+# =========================================================
+def _cwt_costs(engine, n, scales, itemsize, nfft=None):
+    """
+    bytes of working arrays of the cwt of rows of length n: (per row and
+    scale, per row), as taken by _block_shape. For 'fft' these are the
+    kernel product and its inverse transform, and the row, its padded copy,
+    its transform, the irfft scratch and the power of the row. For 'pywt'
+    (one row at a time) they are the coefficients, and the convolution of
+    the largest scale and the power of the row
+    """
+    if engine=='fft':
+        half = 2*(nfft//2 + 1)
+        return itemsize*(half + nfft), itemsize*(n + 2*nfft + half) + 8*len(scales)
+    elif engine=='pywt':
+        return itemsize*n, 8*(16*n + 64*int(np.max(scales))) + 8*len(scales)
+    raise ValueError("engine must be 'pywt' or 'fft'")
+
+logger = logging.getLogger('dgs')
+
+# percentiles of the cumulative distribution reported by dgs
+_PERCENTILES = [.05,.1,.16,.25,.3,.5,.75,.84,.9,.95]
+
+# the summary statistics in a dgs result dict, in order
+_STATS = ['mean grain size', 'grain size sorting', 'grain size skewness', 'grain size kurtosis']
 
 # =========================================================
 def rescale(dat,mn,mx):
     """
     rescales an input dat between mn and mx
     """
-    m = min(dat.flatten())
-    M = max(dat.flatten())
+    m = np.min(dat)
+    M = np.max(dat)
     return (mx-mn)*(dat-m)/(M-m)+mn
 
 ##====================================
 def standardize(img):
-    img = np.array(img)
+    img = np.array(img, dtype=float)
     #standardization using adjusted standard deviation
     N = np.shape(img)[0] * np.shape(img)[1]
     s = np.maximum(np.std(img), 1.0/np.sqrt(N))
     m = np.mean(img)
-    img = (img - m) / s
+    img -= m
+    img /= s
     img = rescale(img, 0, 1)
     del m, s, N
 
     return img
 
 # =========================================================
+def _fft_kernels(n, scales, wavelet='morl', sampling_period=.5, precision=12):
+    """
+    builds the frequency-domain wavelet kernels used by cwt_power_fft
+    for rows of length n, returning (kernels, period, nfft)
+    """
+    if not isinstance(wavelet, pywt.ContinuousWavelet):
+        wavelet = pywt.ContinuousWavelet(wavelet)
+    if wavelet.complex_cwt:
+        raise ValueError('the fft engine only supports real wavelets')
+
+    scales = np.atleast_1d(np.asarray(scales, dtype=float))
+    if np.any(scales <= 0):
+        raise ValueError('scales must only include positive values')
+
+    # same integrated wavelet and sampling as pywt.cwt
+    int_psi, t = pywt.integrate_wavelet(wavelet, precision=precision)
+    step = t[1] - t[0]
+
+    # only the central n outputs are kept, so no tap further than n-1 samples
+    # from the output origin is ever needed and a 2n-1 circular transform is exact
+    nfft = sp_fft.next_fast_len(2*n - 1, real=True)
+    kernels = np.empty((len(scales), nfft//2 + 1), dtype=complex)
+    buf = np.zeros(nfft)
+    for i, scale in enumerate(scales):
+        j = (np.arange(scale * (t[-1] - t[0]) + 1) / (scale * step)).astype(int)
+        j = j[j < int_psi.size]
+        k = int_psi[j][::-1]
+        if k.size < 2:
+            raise ValueError('Selected scale of {} too small.'.format(scale))
+        # fold pywt's diff and -sqrt(scale) into the kernel
+        k = -np.sqrt(scale) * np.diff(np.hstack((0, k, 0)))
+        # shift so that output sample 0 lines up with pywt's cropped coefficients
+        off = (k.size - 3)//2 + 1
+        lo = max(0, off - (n - 1)); hi = min(k.size, off + n)
+        buf[:] = 0
+        buf[np.arange(lo - off, hi - off) % nfft] = k[lo:hi]
+        kernels[i] = sp_fft.rfft(buf)
+
+    frequencies = pywt.scale2frequency(wavelet, scales, precision) / sampling_period
+    period = 1. / np.atleast_1d(frequencies)
+
+    return kernels, period, nfft
+
+# =========================================================
+class FilterBankCache(object):
+    """
+    least-recently-used store of the wavelet filter banks (kernel FFTs,
+    periods and transform length) built by _fft_kernels, keyed on
+    (row length, scales, wavelet, sampling period, dtype). hits and misses count
+    lookups so a batch can confirm banks are being reused
+    """
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._banks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, n, scales, wavelet='morl', sampling_period=.5, dtype=np.float64):
+        """
+        returns (kernels, period, nfft) for rows of length n, building
+        and storing the bank on a miss. Kernels are complex64 for
+        dtype=float32 rows and complex128 otherwise
+        """
+        scales = np.atleast_1d(np.asarray(scales, dtype=float))
+        dtype = np.dtype(dtype)
+        key = (int(n), scales.tobytes(), getattr(wavelet, 'name', wavelet), float(sampling_period), dtype.name)
+        with self._lock:
+            if key in self._banks:
+                self.hits += 1
+                self._banks.move_to_end(key)
+                return self._banks[key]
+            self.misses += 1
+
+        bank = _fft_kernels(n, scales, wavelet, sampling_period)
+        if dtype==np.float32:
+            bank = (bank[0].astype(np.complex64),) + bank[1:]
+        bank[0].setflags(write=False)
+        bank[1].setflags(write=False)
+
+        with self._lock:
+            self._banks[key] = bank
+            self._banks.move_to_end(key)
+            while len(self._banks) > self.maxsize:
+                self._banks.popitem(last=False)
+        return bank
+
+    def info(self):
+        """
+        returns a dict of hits, misses, number of stored banks and their size in bytes
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._banks),
+                    'maxsize': self.maxsize, 'nbytes': sum(b[0].nbytes + b[1].nbytes for b in self._banks.values())}
+
+    def clear(self):
+        """
+        empties the cache and resets the counters
+        """
+        with self._lock:
+            self._banks.clear()
+            self.hits = 0
+            self.misses = 0
+
+# filter banks shared by every call in this process
+FILTER_BANKS = FilterBankCache()
+
+# =========================================================
+def cwt_power_fft(rows, scales, wavelet='morl', sampling_period=.5, max_bytes=None):
+    """
+    batched continuous wavelet transform of every row in the 2D array rows,
+    returning the mean wavelet power of each row at each scale, normalised by
+    period**2 as in dgs, and the periods. A single FFT of the row block is
+    multiplied against all wavelet kernels at once (in blocks of rows and
+    scales that keep the working arrays under max_bytes, default
+    _FFT_BLOCK_BYTES). Kernels are taken from
+    the module-level FILTER_BANKS cache, so rows of a size already seen cost
+    no kernel setup. Power agrees with looping
+    pywt.cwt(row, scales, wavelet, sampling_period) over rows to a relative
+    tolerance of 1e-8 (differences are FFT rounding, typically ~1e-15).
+    float32 rows are transformed in single precision
+    """
+    rows = np.atleast_2d(np.asarray(rows))
+    if rows.dtype!=np.float32:
+        rows = rows.astype(float)
+    nrows, n = rows.shape
+
+    kernels, period, nfft = FILTER_BANKS.get(n, scales, wavelet, sampling_period, rows.dtype)
+
+    per, row = _cwt_costs('fft', n, period, rows.itemsize, nfft)
+    nr, ns = _block_shape(nrows, len(period), per, max_bytes or _FFT_BLOCK_BYTES, row)
+    P = np.empty((nrows, len(period)))
+    for r in range(0, nrows, nr):
+        X = sp_fft.rfft(rows[r:r+nr], nfft, axis=-1)
+        for i in range(0, len(period), ns):
+            cfs = sp_fft.irfft(X[:, None, :] * kernels[None, i:i+ns, :], nfft, axis=-1)[..., :n]
+            P[r:r+nr, i:i+ns] = np.mean(cfs**2, axis=-1)
+            # free them before the next block is transformed
+            del cfs
+
+    return P / period**2, period
+
+# =========================================================
+def _to_grey(im, transpose=True):
+    """
+    converts a 2D grey or 3D colour (rgb or rgba) image array to a 2D
+    grey image, transposed (unless transpose is False) so that rows are the
+    longer dimension. The grey image of a uint8 colour image is uint8; of
+    any other (integer or float) colour image it is the float luma, which
+    is rescaled by its range afterwards anyway
+    """
+    im = np.squeeze(np.asarray(im))  # squeeze singleton dimensions
+    if im.dtype.kind not in 'biuf':
+        raise ValueError('unsupported image dtype '+str(im.dtype))
+
+    if im.ndim==3: # if rgb, convert to grey
+        if im.shape[2]<3:
+            raise ValueError('colour images need at least 3 bands, got shape '+str(im.shape))
+        grey = 0.299 * im[:,:,0]
+        grey += 0.5870*im[:,:,1]
+        grey += 0.114*im[:,:,2]
+        im = grey.astype('uint8') if im.dtype==np.uint8 else grey
+
+    if im.ndim!=2:
+        raise ValueError('expected a 2D grey or 3D colour image, got shape '+str(im.shape))
+
+    nx,ny = np.shape(im)
+    if nx>ny and transpose:
+        im=im.T
+    return im
+
 # =========================================================
-def dgs(image, resolution=1, maxscale=4, verbose=1, x=-0.5, f=0):
+@contextmanager
+def _profiled(profile, image=None):
+    """
+    yields the record that _stage fills in during one dgs call (None when
+    profile is None) and hands it to profile once the call succeeds
+    """
+    if profile is None:
+        yield None
+        return
+    trace = getattr(profile, 'trace_memory', False) and not tracemalloc.is_tracing()
+    if trace:
+        tracemalloc.start()
+    record = {'image': image}
+    t0 = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['total'] = time.perf_counter() - t0
+        if trace:
+            tracemalloc.stop()
+    profile(record)
+
+# =========================================================
+@contextmanager
+def _stage(record, name):
+    """
+    adds the wall time of the enclosed block to record[name] and, while
+    tracemalloc is tracing, its peak allocation to record[name+' peak bytes']
+    """
+    if record is None:
+        yield
+        return
+    trace = tracemalloc.is_tracing()
+    if trace:
+        start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record[name] = record.get(name, 0) + time.perf_counter() - t0
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1] - start
+            record[name+' peak bytes'] = max(record.get(name+' peak bytes', 0), peak)
+
+# =========================================================
+class StageProfiler(object):
+    """
+    profile callback for dgs, dgs_array, dgs_batch, dgs_imap and dgs_stream.
+    Each call receives one record per image: the wall time in seconds of
+    each stage ('read', 'standardize', 'denoise', 'cwt', 'stats') and the
+    'total', plus '<stage> peak bytes' of traced allocation when
+    trace_memory is True (tracemalloc slows numpy allocation, timing alone
+    costs a few microseconds per image). Records are logged at DEBUG level
+    on the 'dgs' logger, aggregated by summary(), and the last keep of
+    them (None for all, which grows without limit over a long batch) are
+    kept in records
+    """
+    def __init__(self, trace_memory=False, keep=1000):
+        self.trace_memory = trace_memory
+        self.keep = keep
+        self.records = deque(maxlen=keep)
+        self.count = 0
+        self.totals = {}
+        self.maxima = {}
+
+    def __call__(self, record):
+        logger.debug('dgs stages %s', record)
+        self.count += 1
+        for k, v in record.items():
+            if k=='image':
+                continue
+            if not k.endswith('peak bytes'):
+                self.totals[k] = self.totals.get(k, 0) + v
+            self.maxima[k] = max(self.maxima.get(k, 0), v)
+        self.records.append(record)
+
+    def summary(self):
+        """
+        returns {'images': n, stage: {'total', 'mean', 'max'}, ...} in seconds,
+        and the largest '<stage> peak bytes' when memory was traced
+        """
+        out = {'images': self.count}
+        for k, v in self.totals.items():
+            out[k] = {'total': v, 'mean': v/max(self.count, 1), 'max': self.maxima[k]}
+        for k, v in self.maxima.items():
+            if k.endswith('peak bytes'):
+                out[k] = v
+        return out
+
+# =========================================================
+def _rescale_inplace(a, mx, lo=None, hi=None):
+    """
+    rescale(a, 0, mx) done in place on the float array a, whose minimum
+    and maximum (lo and hi) can be given if already known
+    """
+    lo = np.min(a) if lo is None else lo
+    hi = np.max(a) if hi is None else hi
+    a -= lo
+    a *= mx/(float(hi)-float(lo))
+    return a
+
+# =========================================================
+def _noise_sigma(detail):
+    """
+    median absolute deviation estimate of the standard deviation of
+    gaussian noise from finest-scale wavelet detail coefficients, ignoring
+    zeros (as skimage's estimate_sigma). The image is scaled 0-1, so
+    coefficients within a few eps of 0 are zeros lost to rounding (as in
+    float32, where they would otherwise halve the median)
+    """
+    detail = np.abs(detail)
+    detail = detail[detail > 8*np.finfo(detail.dtype).eps]
+    if detail.size==0:
+        return 0.
+    return float(np.median(detail)/stats.norm.ppf(0.75))
+
+# =========================================================
+def denoise(im, sigma=None, rows=None, factor=2):
+    """
+    VisuShrink wavelet denoising of the 2D float image im (scaled 0-1) with
+    the settings of dgs: haar wavelet, 3 fewer levels than the maximum, and
+    soft thresholds at factor*sigma*sqrt(2*log(im.size)), as skimage's
+    denoise_wavelet(im, sigma=factor*sigma, method='VisuShrink'). The image
+    is decomposed once; if sigma is None the noise level is estimated from
+    the finest diagonal detail coefficients of that decomposition. If rows
+    is given, only the bands of 2**levels rows that contain them are
+    decomposed and denoised (exactly as in the whole image, since haar
+    bands do not overlap) and the other rows are returned unchanged.
+    Returns the denoised image and sigma
+    """
+    wavelet = pywt.Wavelet('db1')
+    level = max(pywt.dwtn_max_level(im.shape, wavelet) - 3, 1)
+    band = 2**level
+    if rows is None:
+        bands = [(0, im.shape[0])]
+    else:
+        b = np.unique(np.asarray(rows)//band)
+        new = np.r_[True, np.diff(b)>1]
+        bands = [(start*band, min((stop+1)*band, im.shape[0]))
+                 for start, stop in zip(b[new], b[np.r_[new[1:], True]])]
+
+    # the last band may be shorter than 2**level, with the same padding as in the whole image
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        coeffs = [pywt.wavedec2(im[i:j], wavelet, level=level) for i, j in bands]
+    if sigma is None:
+        sigma = _noise_sigma(np.concatenate([c[-1][2].ravel() for c in coeffs]))
+        if sigma==0:
+            warnings.warn('no pixel-level detail to estimate the noise from (e.g. an image upscaled by '
+                          'repeating pixels), so the filter leaves the image unchanged')
+    thresh = factor*sigma*np.sqrt(2*np.log(im.size))
+    if thresh==0:
+        # nothing to remove, and pywt's soft threshold of 0 turns zeros into NaN
+        return im.copy(), sigma
+
+    out = np.empty_like(im) if rows is None else im.copy()
+    for (i, j), c in zip(bands, coeffs):
+        c = [c[0]] + [tuple(pywt.threshold(d, thresh, 'soft') for d in detail) for detail in c[1:]]
+        out[i:j] = pywt.waverec2(c, wavelet)[:j-i, :im.shape[1]]
+    return out, sigma
+
+# =========================================================
+def estimate_noise(image):
+    """
+    noise level (sigma) that dgs with f=1 estimates for image (a file name
+    or an array), from the finest diagonal haar coefficients of the grey
+    image scaled 0-1. Estimate it once for a camera and pass it as
+    dgs(..., f=1, sigma=...) to use the same threshold for a whole batch
+    """
+    if isinstance(image, str):
+        try:
+            image = imread(image)
+        except Exception as e:
+            raise IOError('cannot open '+image) from e
+    im = _to_grey(image)
+    lo, hi = np.min(im), np.max(im)
+    if lo==hi:
+        raise ValueError('image is uniform; no grains to analyse')
+    u = _rescale_inplace(np.subtract(im, lo, dtype=float), 1, 0, float(hi)-float(lo))
+    return _noise_sigma(pywt.dwt2(u, 'db1')[1][2])
+
+# =========================================================
+def _preprocess(im, f=0, record=None, dtype=np.float64, sigma=None, nrows=None):
+    """
+    stages 1 and 2 of dgs: grey conversion, standardization and optional
+    denoising, returning the image rescaled to 0-255 for the cwt as a
+    float64 or float32 array. standardize is an affine map with positive
+    slope, so standardizing then rescaling to 0-1 equals rescaling the
+    grey image directly (to rounding); this is done in one pass over a
+    single working array. sigma fixes the noise level of the denoiser
+    (see denoise). If nrows is given, only the bands containing the nrows
+    rows sampled by the cwt are denoised, and the image is rescaled by the
+    range of those rows, not of the whole denoised image. The cwt of a row
+    depends a little on that offset near its ends, so the result is close
+    to, but not the same as, denoising the whole image
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError('dtype must be float32 or float64')
+
+    with _stage(record, 'standardize'):
+        im = _to_grey(im)
+        lo, hi = np.min(im), np.max(im)
+        if lo==hi:
+            raise ValueError('image is uniform; no grains to analyse')
+        region = np.subtract(im, lo, dtype=dtype)
+
+    if f!=1:
+        with _stage(record, 'standardize'):
+            return _rescale_inplace(region, 255, 0, float(hi)-float(lo))
+
+    # wavelet denoising (VisuShrink) from a single decomposition
+    _rescale_inplace(region, 1, 0, float(hi)-float(lo))
+    with _stage(record, 'denoise'):
+        rows = None if nrows is None else np.linspace(1,region.shape[0]-1,nrows).astype(int)
+        region, sigma = denoise(region, sigma, rows)
+    if record is not None:
+        record['sigma'] = sigma
+
+    with _stage(record, 'standardize'):
+        if rows is None:
+            return _rescale_inplace(region, 255)
+        return _rescale_inplace(region, 255, np.min(region[rows]), np.max(region[rows]))
+
+# =========================================================
+def _preprocess_rows(im, nrows, record=None, dtype=np.float64):
+    """
+    stages 1 and 2 of dgs without denoising, for the nrows rows sampled by
+    the cwt only: the grey image is rescaled to 0-255 by its full range,
+    exactly as in _preprocess, but only the sampled rows are converted to
+    float. Returns those rows and the shape of the whole grey image
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError('dtype must be float32 or float64')
+
+    with _stage(record, 'standardize'):
+        im = _to_grey(im)
+        lo, hi = np.min(im), np.max(im)
+        if lo==hi:
+            raise ValueError('image is uniform; no grains to analyse')
+        rows = np.linspace(1,im.shape[0]-1,nrows).astype(int)
+        region = np.subtract(im[rows], lo, dtype=dtype)
+        return _rescale_inplace(region, 255, 0, float(hi)-float(lo)), im.shape
+
+# =========================================================
+def _read_image(source, grey=False, reduce=1):
+    """
+    decodes the image file (or bytes) source for dgs. By default this is
+    imageio.imread. grey=True decodes straight to a grey image (for JPEG,
+    just the luma channel), and reduce=2, 4 or 8 decodes at that fraction
+    of the full size: JPEG images are decoded at reduced size by the codec
+    (DCT scaling) and other formats are decoded in full and averaged over
+    reduce x reduce blocks. Each pixel then spans reduce pixels of the
+    original, so resolution must be multiplied by reduce. Only 8-bit grey
+    and colour images (PIL modes L, RGB and YCbCr) are decoded by PIL;
+    others (16-bit, palette, alpha, ...) are read by imread and converted
+    by _to_grey, so that they keep their full range of grey levels
+    """
+    if not grey and reduce==1:
+        return imread(source)
+    if reduce not in (1, 2, 4, 8):
+        raise ValueError('reduce must be 1, 2, 4 or 8')
+
+    from PIL import Image
+    im, done = None, 1
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as img:
+        if img.mode in ('L', 'RGB', 'YCbCr'):
+            width = img.size[0]
+            if reduce>1:
+                img.draft('L' if grey else 'RGB', (img.size[0]//reduce, img.size[1]//reduce))
+            done = int(round(width/img.size[0]))
+            im = np.asarray(img.convert('L' if grey or img.mode=='L' else 'RGB'))
+    if im is None:
+        im = _to_grey(imread(source), transpose=False)
+
+    # the rest of the reduction, for codecs without reduced-size decoding
+    r = reduce//done
+    if r>1:
+        nx, ny = im.shape[0]//r*r, im.shape[1]//r*r
+        block = im[:nx, :ny].reshape((nx//r, r, ny//r, r) + im.shape[2:])
+        im = np.mean(block, axis=(1, 3)).astype(im.dtype)
+    return im
+
+# =========================================================
+def _scale_grid(n, maxscale, grid='linear', voices=12):
+    """
+    wavelet scales for an image whose smaller dimension is n. 'linear' is
+    every integer scale from 3 up to n/maxscale, 'log' is voices scales per
+    octave from 3, ending at the same largest scale as 'linear' (rows whose
+    power peaks at the end of the range would otherwise move with the
+    grid), and an array is taken as the grain sizes (periods, in pixels) at
+    which to evaluate the distribution
+    """
+    if isinstance(grid, str):
+        if grid=='linear':
+            return np.arange(3, n/maxscale, 1)
+        elif grid=='log':
+            end = np.arange(3, n/maxscale, 1)[-1]
+            scales = 3*2**(np.arange(np.ceil(voices*np.log2(n/maxscale/3)))/voices)
+            return np.hstack((scales[scales<end], end))
+        raise ValueError("grid must be 'linear', 'log' or an array of grain sizes")
+
+    sizes = np.asarray(grid, dtype=float)
+    if sizes.ndim!=1 or len(sizes)<2 or np.any(sizes<=0) or np.any(np.diff(sizes)<=0):
+        raise ValueError('grid must be an increasing array of at least 2 positive grain sizes')
+    return sizes*pywt.central_frequency('morl', precision=12)/.5
+
+# =========================================================
+def _scale_weights(scales):
+    """
+    width of the bin around each scale, in units of the 'linear' grid
+    spacing, so that the wavelet power (a density over scale) can be turned
+    into the mass in each bin. Bins reach halfway to their neighbours, and
+    the end bins half a unit beyond the end scales, so every grid covers
+    the same range of scales as 'linear', where the widths are exactly 1
+    """
+    scales = np.asarray(scales, dtype=float)
+    return np.diff(np.hstack((scales[:1]-.5, (scales[:-1]+scales[1:])/2, scales[-1:]+.5)))
+
+# =========================================================
+def _cdf_sizes(period, w=1):
+    """
+    the grain size at which the cumulative frequency through each bin (of
+    width w, see _scale_weights) is reached by the percentile
+    interpolation: its upper edge less half the 'linear' grid spacing. That
+    is the bin's own period on the 'linear' grid, and placing the bins of
+    other grids the same way keeps their percentiles comparable with it
+    """
+    if np.all(np.asarray(w)==1):
+        return period
+    # half a unit of scale, as a period
+    half = .25/pywt.central_frequency('morl', precision=12)
+    return np.hstack(((period[:-1]+period[1:])/2 - half, period[-1:]))
+
+# =========================================================
+def _pywt_power(row, scales, nblock, out=None):
+    """
+    mean wavelet power of one row at each scale (normalised by period**2)
+    from pywt.cwt, nblock scales at a time, and the periods
+    """
+    power = np.empty(len(scales)) if out is None else out
+    period = np.empty(len(scales))
+    for j in range(0, len(scales), nblock):
+        [cfs, frequencies] = pywt.cwt(row, scales[j:j+nblock],  'morl' , .5)
+        period[j:j+nblock] = 1. / frequencies
+        # morl coefficients are real, so square in place
+        power[j:j+nblock] = np.mean(np.square(cfs, out=cfs), axis=1)
+        # free them before the next block is transformed
+        del cfs
+    power /= period**2
+    return power, period
+
+# =========================================================
+def _thread_map(fn, items, threads=1):
+    """
+    map(fn, items), in order, spread over a pool of threads if threads > 1.
+    At most threads+1 results are pending at once
+    """
+    if threads is None or threads<=1:
+        yield from map(fn, items)
+        return
+    with ThreadPoolExecutor(threads) as ex:
+        pending = deque()
+        for item in items:
+            pending.append(ex.submit(fn, item))
+            if len(pending) > threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# =========================================================
+def _cwt_power(original, scales, engine='pywt', rows=None, max_bytes=None, threads=1):
+    """
+    stage 3 of dgs: wavelet power of the rows of original with the given
+    indices (default 100 evenly spaced rows) at the given scales (see
+    _scale_grid), returned as a (rows, scales) array together with the
+    periods. If max_bytes is given, the coefficients are computed in blocks
+    of scales (and rows) whose working arrays stay under max_bytes (per
+    thread). threads > 1 splits the rows into one contiguous block per
+    thread; the power of a row does not depend on the blocking, so the
+    result is identical to the serial one
+    """
+    nx, ny = original.shape
+    if rows is None:
+        rows = np.linspace(1,nx-1,100).astype(int)
+    if threads is not None and threads>1 and len(rows)>1:
+        if engine=='fft':
+            # build the filter bank once, before the threads need it
+            FILTER_BANKS.get(ny, scales, 'morl', .5, original.dtype)
+        parts = list(_thread_map(lambda r: _cwt_power(original, scales, engine, r, max_bytes),
+                                 np.array_split(rows, min(threads, len(rows))), threads))
+        return np.vstack([P for P, period in parts]), parts[0][1]
+    if engine=='fft':
+        # all sampled rows transformed together
+        return cwt_power_fft(original[rows,:], scales, 'morl', .5, max_bytes)
+    elif engine=='pywt':
+        nblock = len(scales)
+        if max_bytes is not None:
+            per, row = _cwt_costs('pywt', ny, scales, original.itemsize)
+            nblock = _block_shape(1, len(scales), per, max_bytes, row)[1]
+        P = np.empty((len(rows), len(scales)))
+        for i, k in enumerate(rows):
+            _, period = _pywt_power(original[k,:], scales, nblock, P[i])
+        return P, period
+    else:
+        raise ValueError("engine must be 'pywt' or 'fft'")
+
+# =========================================================
+def _cwt_power_bounded(original, scales, engine, rows, max_bytes, threads=1):
+    """
+    stage 3 of dgs in bounded memory: rows and scales are transformed in
+    blocks whose working arrays stay under max_bytes, and only the running
+    sum of power over rows and the peak period of each row are kept, in
+    preallocated buffers. Returns the mean power at each scale, the peak
+    period of each row, the periods, and the peak size in bytes of the
+    working arrays (see _cwt_costs; the filter bank of engine='fft' is
+    cached between calls and not counted). With threads > 1, up to threads
+    blocks are transformed at once (each under max_bytes) and summed in the
+    serial order, so the result is unchanged
+    """
+    nx, ny = original.shape
+    nfft = FILTER_BANKS.get(ny, scales, 'morl', .5, original.dtype)[2] if engine=='fft' else None
+    per, row = _cwt_costs(engine, ny, scales, original.itemsize, nfft)
+    # pywt transforms one row at a time
+    nr, ns = _block_shape(len(rows) if engine=='fft' else 1, len(scales), per, max_bytes, row)
+
+    threads = max(1, threads or 1)
+    psum = np.zeros(len(scales))
+    peak = np.empty(len(rows), dtype=int)
+
+    def block(i):
+        if engine=='fft':
+            return cwt_power_fft(original[rows[i:i+nr],:], scales, 'morl', .5, max_bytes)
+        Pb = np.empty((1, len(scales)))
+        _, period = _pywt_power(original[rows[i],:], scales, ns, Pb[0])
+        return Pb, period
+
+    starts = range(0, len(rows), nr)
+    for i, (Pb, period) in zip(starts, _thread_map(block, starts, threads)):
+        psum += np.sum(Pb, axis=0)
+        peak[i:i+nr] = np.argmax(Pb, axis=1)
+
+    # the blocks being transformed, the finished one _thread_map may hold, and the accumulators
+    running = min(threads, len(starts))
+    nbytes = running*nr*(ns*per + row) + (running>1)*nr*8*len(scales) + psum.nbytes + peak.nbytes
+    return psum/len(rows), period[peak], period, nbytes
+
+# =========================================================
+def _sampling_order(n):
+    """
+    order in which to visit n evenly spaced rows so that every prefix is
+    spread over the whole image (bit-reversed, van der Corput order)
+    """
+    bits = max(1, int(np.ceil(np.log2(max(n, 2)))))
+    i = np.arange(n)
+    rev = np.zeros(n, dtype=int)
+    for b in range(bits):
+        rev |= ((i >> b) & 1) << (bits - 1 - b)
+    return np.argsort(rev, kind='stable')
+
+# =========================================================
+def _cwt_power_adaptive(original, scales, engine, rows, tol, x=-0.5, resolution=1, batch=10,
+                        max_bytes=None, threads=1):
+    """
+    stage 3 of dgs with adaptive row sampling: the candidate rows are
+    transformed batch at a time, in an order spread over the image, until
+    both the normalised mean power spectrum (L1 distance) and d50 (relative
+    change) move by less than tol from one batch to the next, or every
+    row has been used. Returns the power of the rows used, in image order,
+    and the periods. max_bytes and threads are as for _cwt_power
+    """
+    order = _sampling_order(len(rows))
+    w = _scale_weights(scales)
+    used = np.zeros(len(rows), dtype=bool)
+    P = None; last = None
+    for i in range(0, len(rows), batch):
+        idx = order[i:i+batch]
+        Pb, period = _cwt_power(original, scales, engine, rows[idx], max_bytes, threads)
+        if P is None:
+            P = np.empty((len(rows), Pb.shape[1]))
+        P[idx] = Pb
+        used[idx] = True
+
+        p, mbar = _mean_spectrum(P[used], period, w)
+        d50 = _grain_size_stats(p, mbar, period, x, resolution, w)['percentile_values'][_PERCENTILES.index(.5)]
+        if last is not None and np.sum(np.abs(p - last[0])) < tol and abs(d50 - last[1]) <= tol*abs(d50):
+            break
+        last = (p, d50)
+
+    return P[used], period
+
+# =========================================================
+def _mean_spectrum(P, period, w=1, M=None):
+    """
+    the (rows, scales) power P averaged over rows and turned into the
+    normalised mass in each bin of width w, and the mean of the row-wise
+    peak periods. If the peak periods M are given, P is already the mean
+    power over rows
+    """
+    if M is None:
+        M = period[np.argmax(P, axis=1)]
+        P = np.mean(P, axis=0, dtype=float)
+    p = P*w
+    return np.array(p/np.sum(p)), np.mean(M)
+
+# =========================================================
+def _interp_rows(q, xp, fp):
+    """
+    np.interp(q, xp[i], fp[i]) for every row i of the 2D arrays xp and fp
+    (xp non-decreasing along rows, starting at or below min(q)), done as
+    one vectorised binary search over all rows
+    """
+    nrow, n = xp.shape
+    q = np.broadcast_to(np.asarray(q, dtype=float), (nrow, np.size(q)))
+    lo = np.zeros(q.shape, dtype=int)
+    hi = np.full(q.shape, n-1)
+    # bisect for xp[lo] <= q < xp[hi], hi = lo+1
+    while np.any(hi - lo > 1):
+        mid = (lo + hi)//2
+        below = np.take_along_axis(xp, mid, axis=1) <= q
+        lo = np.where(below, mid, lo)
+        hi = np.where(below, hi, mid)
+
+    x0 = np.take_along_axis(xp, lo, axis=1); x1 = np.take_along_axis(xp, hi, axis=1)
+    f0 = np.take_along_axis(fp, lo, axis=1); f1 = np.take_along_axis(fp, hi, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = (f1 - f0)/(x1 - x0)*(q - x0) + f0
+    return np.where(q >= xp[:,-1:], fp[:,-1:], out)
+
+# =========================================================
+def _grain_size_stats_many(p, mbar, period, x=-0.5, resolution=1, w=1):
+    """
+    stages 4 and 5 of dgs for m spectra on the same scale grid at once: p is
+    the (m, scales) normalised mean wavelet power in each bin (see
+    _mean_spectrum), mbar the mean of the row-wise peak periods of each, and
+    w the bin widths of the grid (see _scale_weights). x and resolution are
+    scalars or one value per spectrum. Returns the dgs result dict with a
+    leading axis of length m on every value except 'percentiles'. Bins
+    whose smoothed mass is zero keep a zero frequency and are skipped by
+    the percentile interpolation
+    """
+    p = np.atleast_2d(p)
+    m = len(p)
+    scales = np.array(period, dtype=float)
+    mbar = np.reshape(mbar, (m, 1))
+    srt = np.sqrt(np.sum(p*((scales-mbar)**2), axis=-1, keepdims=True))
+
+    # the smoothing density, like p, is a mass per bin
+    p = p+stats.norm.pdf(scales, mbar, srt/2)*w
+    p = p/np.sum(p, axis=-1, keepdims=True)
+
+    # area-by-number to volume-by-number
+    x = np.broadcast_to(np.asarray(x, dtype=float), (m,))
+    r_v = p*scales**x[:,None]
+    r_v = r_v / np.sum(r_v, axis=-1, keepdims=True) #volume-by-weight proportion
+
+    # calc particle size stats, in real scales (resolution is mm/pixel)
+    return grain_size_stats(r_v, np.broadcast_to(scales, r_v.shape), p>0, resolution,
+                            np.broadcast_to(_cdf_sizes(scales, w), r_v.shape))
+
+# =========================================================
+def grain_size_stats(freqs, bins, mask=None, resolution=1, sizes=None):
+    """
+    stage 5 of dgs for m distributions at once: freqs and bins are (m, n)
+    arrays of volume-by-weight frequencies and grain sizes, padded to a
+    common n, and mask (default: freqs > 0) marks the bins of each
+    distribution that are used. resolution (mm/pixel) is a scalar or one
+    value per distribution and scales the bins, so it converts results
+    computed in pixels. sizes (like bins, default bins) are the grain sizes
+    at which the cumulative frequency through each bin is reached; dgs
+    sets them for grids other than 'linear' (see _cdf_sizes), so the
+    percentiles of stored distributions from those grids, recomputed here
+    without them, differ a little from those dgs returned. Returns the dgs
+    result dict with a leading axis of length m on every value except
+    'percentiles'; frequencies and bins come back padded, with unused bins
+    at zero frequency (see pad_distributions, and save_results to store
+    them)
+    """
+    freqs = np.atleast_2d(np.asarray(freqs, dtype=float))
+    m = len(freqs)
+    valid = freqs > 0 if mask is None else np.asarray(mask, dtype=bool) & (freqs > 0)
+    freqs = np.where(valid, freqs, 0)
+    res = np.reshape(np.broadcast_to(np.asarray(resolution, dtype=float), (m,)), (m, 1))
+    scales = np.where(valid, bins, 0)*res
+
+    cdf = np.cumsum(freqs, axis=-1)
+    cdf = np.hstack((np.zeros((m,1)), cdf))
+    edges = np.hstack((np.zeros((m,1)), scales if sizes is None else np.where(valid, sizes, 0)*res))
+    if not np.all(valid):
+        # an unused bin takes the size of the last used one, which is the
+        # same interpolation as leaving it out
+        last = np.maximum.accumulate(np.where(np.hstack((np.ones((m,1), dtype=bool), valid)),
+                                              np.arange(freqs.shape[1]+1), 0), axis=-1)
+        edges = np.take_along_axis(edges, last, axis=-1)
+    pd = _interp_rows(_PERCENTILES, cdf, edges)
+
+    mnsz = np.sum(freqs*scales, axis=-1)
+    d = scales - mnsz[:,None]
+    # freqs*d**k for k = 2, 3, 4 by repeated in-place products (d**3 and
+    # d**4 go through pow, several times slower)
+    fd = freqs*d; fd *= d
+    srt = np.sqrt(np.sum(fd, axis=-1))
+    fd *= d
+    sk = np.sum(fd, axis=-1)/(100*srt**3)
+    fd *= d
+    kurt = np.sum(fd, axis=-1)/(100*srt**4)
+
+    return {'mean grain size': mnsz, 'grain size sorting': srt, 'grain size skewness': sk, 'grain size kurtosis': kurt, 'percentiles': list(_PERCENTILES), 'percentile_values': pd, 'grain size frequencies': freqs, 'grain size bins': scales}
+
+# =========================================================
+def pad_distributions(results):
+    """
+    returns the (m, n) arrays freqs, bins and mask of grain_size_stats for
+    a list of dgs result dicts, or for a result set in the layout of
+    load_results, padding each distribution to the longest one
+    """
+    cols = results if isinstance(results, dict) else _columnar(['']*len(results), results)
+    offsets = np.asarray(cols['offsets'])
+    nbins = np.diff(offsets)
+    mask = np.arange(nbins.max() if len(nbins) else 0) < nbins[:,None]
+    freqs = np.zeros(mask.shape); bins = np.zeros(mask.shape)
+    freqs[mask] = cols['grain size frequencies'][offsets[0]:offsets[-1]]
+    bins[mask] = cols['grain size bins'][offsets[0]:offsets[-1]]
+    return freqs, bins, mask
+
+# =========================================================
+def _grain_size_stats(p, mbar, period, x=-0.5, resolution=1, w=1):
+    """
+    stages 4 and 5 of dgs: turns the normalised mean wavelet power p in
+    each bin (see _mean_spectrum), and the mean of the row-wise peak periods
+    mbar, into the dgs result dict. w is the bin widths of the scale grid
+    (see _scale_weights). If x is an array, every value except 'percentiles'
+    gets a leading axis over x. Empty bins are left out of the frequencies
+    and bins
+    """
+    x = np.asarray(x, dtype=float)
+    res = _grain_size_stats_many(np.broadcast_to(p, (max(x.size, 1), len(p))), np.full(max(x.size, 1), mbar),
+                                 period, x.reshape(-1), resolution, w)
+    keep = res['grain size frequencies'][0] > 0
+    for k in ('grain size frequencies', 'grain size bins'):
+        res[k] = res[k][:, keep]
+    for k in res:
+        if k!='percentiles':
+            res[k] = res[k][0] if x.ndim==0 else res[k].reshape(x.shape + res[k].shape[1:])
+    return res
+
+# =========================================================
+# =========================================================
+def dgs(image, resolution=1, maxscale=4, verbose=1, x=-0.5, f=0, engine='pywt', cache=None, profile=None,
+        nrows=100, tol=None, grid='linear', voices=12, cwt_bytes=None, dtype=np.float64, threads=1,
+        sigma=None, denoise_rows=False, spectra=None, rois=None, labels=None, grey_decode=False, reduce=1):
 
    if verbose==1:
       print("===========================================")
@@ -96,132 +967,1396 @@ def dgs(image, resolution=1, maxscale=4, verbose=1, x=-0.5, f=0):
       print("========REVISION 4.3, NOV 2022===========")
       print("===========================================")
 
-   # exit program if no input folder given
    if not image:
-      print('An image file is required!!!!!!')
-      sys.exit(2)
+      raise ValueError('An image file is required!!!!!!')
 
    # print given arguments to screen and convert data type where necessary
-   if image:
-      print('Input image is '+image)
-   # #
-   # if resolution:
-   #    resolution = np.asarray(resolution,float)
-   #    print('Resolution is '+str(resolution))
-   
-   # if maxscale:
-   #    maxscale = np.asarray(maxscale,int)
-   #    print('Max scale as inverse fraction of data length: '+str(maxscale))
-   
-   # if x:
-   #    x = np.asarray(x, float)
-   #    print('Empirical constant = '+str(x))
+   print('Input image is '+image)
 
    # ======= stage 1 ==========================
    # read image
    if verbose==1:
       print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
       print('Processing image '+image)
-   try:
-       im = imread(image)   # read the image straight with imread
-       im = np.squeeze(im)  # squeeze singleton dimensions
-       if len(np.shape(im))>3:
-           im = im[:, :, :3]            # only keep the first 3 bands
+   if reduce not in (1, 2, 4, 8):
+      raise ValueError('reduce must be 1, 2, 4 or 8')
+   if reduce!=1 and (rois is not None or labels is not None):
+      raise ValueError('rois and labels need reduce=1')
+   with _profiled(profile, image) as record:
+      try:
+          with _stage(record, 'read'):
+              # results for regions are not cached
+              if cache is None or rois is not None or labels is not None:
+                  im = _read_image(image, grey_decode, reduce)
+              else:
+                  with open(image, 'rb') as fid:
+                      data = fid.read()
+                  key = cache.key(data, resolution=resolution, maxscale=maxscale, x=x, f=f, engine=engine,
+                                  nrows=nrows, tol=tol, grid=grid, voices=voices, dtype=np.dtype(dtype).name,
+                                  sigma=sigma, denoise_rows=denoise_rows, grey_decode=grey_decode, reduce=reduce)
+                  # a stored spectrum needs the transform
+                  res = cache.get(key) if spectra is None else None
+                  if res is not None:
+                      return res
+                  im = _read_image(data, grey_decode, reduce)
+      except Exception as e:
+          raise IOError('cannot open '+image) from e
+      # a reduced image has larger pixels
+      resolution = resolution*reduce
+
+      options = dict(nrows=nrows, tol=tol, grid=grid, voices=voices, cwt_bytes=cwt_bytes, dtype=dtype,
+                     threads=threads, sigma=sigma, denoise_rows=denoise_rows, spectra=spectra, image=image)
+      if rois is not None or labels is not None:
+         return _dgs_rois(im, rois, labels, resolution, maxscale, verbose, x, f, engine, record, **options)
+      res = _dgs_image(im, resolution, maxscale, verbose, x, f, engine, record, **options)
+      if cache is not None:
+          cache.put(key, res)
+      return res
 
-       if len(np.shape(im))==3: # if rgb, convert to grey
-          im = (0.299 * im[:,:,0] + 0.5870*im[:,:,1] + 0.114*im[:,:,2]).astype('uint8')
+# =========================================================
+def dgs_array(im, resolution=1, maxscale=4, verbose=1, x=-0.5, f=0, engine='pywt', profile=None,
+              nrows=100, tol=None, grid='linear', voices=12, cwt_bytes=None, dtype=np.float64,
+              threads=1, sigma=None, denoise_rows=False, spectra=None, rois=None, labels=None):
+   """
+   dgs for an image already in memory: a 2D grey array or a 3D colour
+   (rgb/rgba) array. A list of images, a 3D array whose last dimension is
+   not 1, 3 or 4 (a stack of grey images) or a 4D array (a stack of colour
+   images) returns a list with one dict per image. Raises ValueError on
+   arrays that cannot be analysed. profile is an optional callback that
+   receives the stage timings of each image (see StageProfiler).
+   nrows evenly spaced rows are transformed. If tol is given they are
+   instead sampled adaptively, 10 at a time, until the mean power spectrum
+   and d50 change by less than tol between batches (nrows is then the row
+   budget) and the number used is returned as 'rows used'. grid is the
+   scale grid: 'linear' (every integer scale), 'log' (voices scales per
+   octave, far fewer at the coarse end) or an increasing array of grain
+   sizes in pixels. cwt_bytes, if given, is a memory budget in bytes for
+   the wavelet coefficients: they are then computed in blocks under the
+   budget and reduced to running sums, and the peak size of the working
+   arrays is reported to profile as 'cwt working bytes'. dtype=np.float32
+   runs preprocessing and the cwt in single precision, halving their
+   memory use (statistics are always computed in float64). threads > 1
+   spreads the rows over that many threads, for lower latency on a single
+   image; the result is identical to threads=1. With f=1, sigma fixes the
+   noise level of the denoiser instead of estimating it for each image
+   (see estimate_noise), and denoise_rows=True denoises only the bands of
+   rows that contain the rows sampled by the cwt. spectra is an optional
+   callback (e.g. a SpectrumStore) that receives the spectrum behind each
+   result, so that recalibrate can recompute the statistics later.
+   rois, a list of rectangles (top, bottom, left, right) in pixels, or
+   labels, a label image of the same size (0 for pixels to ignore),
+   analyse several regions of the image in one call and return a list of
+   result dicts (one per roi) or a dict keyed by label. The image is
+   converted to grey once and the rows of all regions of the same width
+   go through the cwt together, but each region gets exactly the result
+   of analysing it cropped to its own image. A labelled region is its
+   bounding box, with the pixels of other labels set to the mean grey
+   level of the region
+   """
+   options = dict(nrows=nrows, tol=tol, grid=grid, voices=voices, cwt_bytes=cwt_bytes, dtype=dtype,
+                  threads=threads, sigma=sigma, denoise_rows=denoise_rows, spectra=spectra)
+   if isinstance(im, (list, tuple)) or (np.ndim(im)==3 and np.shape(im)[-1] not in (1,3,4)) or np.ndim(im)==4:
+      return [dgs_array(i, resolution, maxscale, verbose, x, f, engine, profile, rois=rois, labels=labels, **options)
+              for i in im]
 
-       nx,ny = np.shape(im)
-       if nx>ny:
-          im=im.T
+   with _profiled(profile) as record:
+      if rois is not None or labels is not None:
+         return _dgs_rois(im, rois, labels, resolution, maxscale, verbose, x, f, engine, record, **options)
+      return _dgs_image(im, resolution, maxscale, verbose, x, f, engine, record, **options)
 
-       im = standardize(im)
+# =========================================================
+def _dgs_image(im, resolution, maxscale, verbose, x, f, engine, record=None, *, nrows=100, tol=None,
+               grid='linear', voices=12, cwt_bytes=None, dtype=np.float64, threads=1, sigma=None,
+               denoise_rows=False, spectra=None, image=None):
+   """
+   stages 1 to 6 of dgs for one image array, timing each stage into record
+   and handing the spectrum behind the result to spectra (see SpectrumStore).
+   The options of dgs_array are keyword-only
+   """
+   if f!=1 and tol is None:
+      # the cwt only needs the sampled rows
+      original, (nx, ny) = _preprocess_rows(im, nrows, record, dtype)
+      rows = np.arange(len(original))
+   else:
+      original = _preprocess(im, f, record, dtype, sigma, nrows if denoise_rows else None)
+      nx, ny = original.shape
+      rows = np.linspace(1,nx-1,nrows).astype(int)
 
-   except: # IOError:
-       print('cannot open '+image)
-       sys.exit(2)
+   if np.minimum(nx,ny)/maxscale <= 4:
+      raise ValueError('image of size '+str((nx,ny))+' is too small for maxscale='+str(maxscale))
 
-   # # ======= stage 2 ==========================
-   # Denoised image using default parameters of `denoise_wavelet`
-   # filter=False
+   # ======= stage 3 ==========================
+   # call cwt to get particle size distribution
+   with _stage(record, 'cwt'):
+      scales = _scale_grid(np.minimum(nx,ny), maxscale, grid, voices)
+      M = None
+      if tol is not None:
+         # stop sampling rows once the spectrum has converged
+         P, period = _cwt_power_adaptive(original, scales, engine, rows, tol, x, resolution,
+                                         max_bytes=cwt_bytes, threads=threads)
+      elif cwt_bytes is not None:
+         # mean power and peak periods only, in bounded memory
+         P, M, period, nbytes = _cwt_power_bounded(original, scales, engine, rows, cwt_bytes, threads)
+         if record is not None:
+            record['cwt working bytes'] = nbytes
+      else:
+         P, period = _cwt_power(original, scales, engine, rows, threads=threads)
+   nused = len(P) if M is None else len(M)
+   if record is not None:
+      record['rows'] = nused
+   return _dgs_result(P, M, period, scales, x, resolution, verbose, record,
+                      rows_used=nused if tol is not None else None, spectra=spectra, image=image)
 
-   if f==1:
-      sigma_est = estimate_sigma(im, multichannel=False, average_sigmas=True)
-      region = denoise_wavelet(im, multichannel=False, rescale_sigma=True,
-                                 method='VisuShrink', mode='soft', sigma=sigma_est*2)
+# =========================================================
+def _dgs_result(P, M, period, scales, x, resolution, verbose, record=None, *, rows_used=None, spectra=None,
+                image=None):
+   """
+   stages 4 to 6 of dgs from the wavelet power P of the sampled rows (or,
+   with their peak periods M, its mean over them) on the scale grid scales
+   """
+   with _stage(record, 'stats'):
+      if M is None:
+         M = period[np.argmax(P, axis=1)]
+         P = np.mean(P, axis=0, dtype=float)
+      w = _scale_weights(scales)
+      p, mbar = _mean_spectrum(P, period, w, M)
+
+      # ======= stages 4 and 5 ===================
+      # volume-by-weight distribution and particle size stats
+      res = _grain_size_stats(p, mbar, period, x, resolution, w)
+
+   if verbose==1:
+      print("d50 = "+str(res['percentile_values'][5]))
+      print("mean size = "+str(res['mean grain size']))
+      print("stdev = "+str(res['grain size sorting']))
+      print("skewness = "+str(res['grain size skewness']))
+      print("kurtosis = "+str(res['grain size kurtosis']))
+
+   # ======= stage 6 ==========================
+   # return a dict object of stats
+   if rows_used is not None:
+      res['rows used'] = rows_used
+   if spectra is not None:
+      spectra({'image': image, 'p': p, 'mbar': mbar, 'M': M, 'period': period, 'w': w})
+   return res
+
+# =========================================================
+def _roi_crops(grey, rois=None, labels=None):
+   """
+   the regions of the grey image to analyse, as (key, crop): each
+   rectangle (top, bottom, left, right) in rois is grey[top:bottom,
+   left:right], keyed by its index, and each label > 0 in the label image
+   labels is its bounding box, with the pixels of other labels filled
+   with the mean grey level of the label, keyed by the label
+   """
+   if rois is not None:
+      crops = []
+      for k, roi in enumerate(rois):
+         top, bottom, left, right = (int(v) for v in roi)
+         if not (0 <= top < bottom <= grey.shape[0] and 0 <= left < right <= grey.shape[1]):
+            raise ValueError('roi '+str(tuple(roi))+' is not inside the image of size '+str(grey.shape))
+         crops.append((k, grey[top:bottom, left:right]))
+      return crops
+
+   labels = np.asarray(labels)
+   if labels.shape != grey.shape:
+      raise ValueError('labels of size '+str(labels.shape)+' do not match the image of size '+str(grey.shape))
+   crops = []
+   for label in np.unique(labels[labels>0]):
+      r, c = np.nonzero(labels==label)
+      box = (slice(r.min(), r.max()+1), slice(c.min(), c.max()+1))
+      inside = labels[box]==label
+      crop = grey[box].copy()
+      crop[~inside] = np.round(np.mean(crop[inside]))
+      crops.append((label.item(), crop))
+   return crops
+
+# =========================================================
+def _dgs_rois(im, rois, labels, resolution, maxscale, verbose, x, f, engine, record=None, *, nrows=100, tol=None,
+              grid='linear', voices=12, cwt_bytes=None, dtype=np.float64, threads=1, sigma=None,
+              denoise_rows=False, spectra=None, image=None):
+   """
+   dgs for several regions of one image array (see _roi_crops): the image
+   is converted to grey once, and each region is preprocessed and
+   analysed exactly as if it had been cropped to its own image, with the
+   sampled rows of all regions of the same width transformed together.
+   Returns a list of result dicts for rois, or a dict keyed by label. The
+   options of dgs_array are keyword-only, as for _dgs_image
+   """
+   with _stage(record, 'standardize'):
+      grey = _to_grey(im, transpose=False)
+   crops = _roi_crops(grey, rois, labels)
+   name = lambda key: None if image is None else str(image)+'#'+str(key)
+
+   if tol is not None or cwt_bytes is not None:
+      # adaptive and bounded sampling work one region at a time
+      options = dict(nrows=nrows, tol=tol, grid=grid, voices=voices, cwt_bytes=cwt_bytes, dtype=dtype,
+                     threads=threads, sigma=sigma, denoise_rows=denoise_rows, spectra=spectra)
+      out = [(key, _dgs_image(crop, resolution, maxscale, verbose, x, f, engine, record, image=name(key), **options))
+             for key, crop in crops]
+   else:
+      originals = []
+      for key, crop in crops:
+         original = _preprocess(crop, f, record, dtype, sigma, nrows if denoise_rows else None)
+         nx, ny = original.shape
+         if np.minimum(nx,ny)/maxscale <= 4:
+            raise ValueError('region '+str(key)+' of size '+str((nx,ny))+' is too small for maxscale='+str(maxscale))
+         originals.append(original)
+
+      # ======= stage 3 ==========================
+      # regions with the same width and scale grid share one cwt call
+      groups = OrderedDict()
+      for i, original in enumerate(originals):
+         groups.setdefault((original.shape[1], min(original.shape)), []).append(i)
+      power = [None]*len(crops)
+      with _stage(record, 'cwt'):
+         for (ny, n), members in groups.items():
+            scales = _scale_grid(n, maxscale, grid, voices)
+            stack = np.concatenate([originals[i][np.linspace(1,originals[i].shape[0]-1,nrows).astype(int)]
+                                    for i in members])
+            P, period = _cwt_power(stack, scales, engine, np.arange(len(stack)), threads=threads)
+            for j, i in enumerate(members):
+               power[i] = (P[j*nrows:(j+1)*nrows], period, scales)
+      if record is not None:
+         record['rows'] = nrows*len(crops)
+
+      out = [(key, _dgs_result(P, None, period, scales, x, resolution, verbose, record,
+                               spectra=spectra, image=name(key)))
+             for (key, crop), (P, period, scales) in zip(crops, power)]
+
+   if record is not None:
+      record['regions'] = len(out)
+   return [res for key, res in out] if rois is not None else OrderedDict(out)
+
+# =========================================================
+def dgs_sweep(image, maxscales, xs, resolution=1, f=0, engine='fft', grid='linear', voices=12, dtype=np.float64,
+              threads=1, sigma=None):
+   """
+   dgs for every combination of maxscale in maxscales and x in xs, from a
+   single cwt of image (a file name or an array) over the scale grids of
+   all the maxscales together (for 'linear', the grid of the smallest
+   maxscale, which holds the others), and the statistics for all values of x are computed together. Returns a dict of
+   dgs result dicts keyed by (maxscale, x), identical to calling dgs with
+   those parameters and the same engine. grid is 'linear' or 'log', dtype
+   float64 or float32, threads the number of threads and sigma the noise
+   level for f=1 (see dgs_array)
+   """
+   if isinstance(image, str):
+      try:
+         im = imread(image)
+      except Exception as e:
+         raise IOError('cannot open '+image) from e
    else:
-      region = im.copy()
+      im = image
+
+   maxscales = np.atleast_1d(maxscales).tolist()
+   xs = np.atleast_1d(np.asarray(xs, dtype=float))
 
-   original = rescale(region,0,255)
+   original = _preprocess(im, f, dtype=dtype, sigma=sigma)
 
    nx, ny = original.shape
+   if np.minimum(nx,ny)/max(maxscales) <= 4:
+      raise ValueError('image of size '+str((nx,ny))+' is too small for maxscale='+str(max(maxscales)))
 
-   # ======= stage 3 ==========================
-   # call cwt to get particle size distribution
+   if not isinstance(grid, str):
+      raise ValueError("dgs_sweep needs grid='linear' or 'log'")
+   grids = [_scale_grid(np.minimum(nx,ny), maxscale, grid, voices) for maxscale in maxscales]
+   scales = np.unique(np.hstack(grids))
+   P, period = _cwt_power(original, scales, engine, threads=threads)
 
-   P = []; M = []
-   for k in np.linspace(1,nx-1,100):
-      [cfs, frequencies] = pywt.cwt(original[int(k),:], np.arange(3, np.minimum(nx,ny)/maxscale, 1),  'morl' , .5)
-      period = 1. / frequencies
-      power =(abs(cfs)) ** 2
-      power = np.mean(np.abs(power), axis=1)/(period**2)
-      P.append(power)
+   out = {}
+   for maxscale, grid_scales in zip(maxscales, grids):
+      idx = np.searchsorted(scales, grid_scales)
+      w = _scale_weights(grid_scales)
+      p, mbar = _mean_spectrum(P[:,idx], period[idx], w)
 
-      M.append(period[np.argmax(power)])
+      res = _grain_size_stats(p, mbar, period[idx], xs, resolution, w)
+      for i, x in enumerate(xs):
+         out[(maxscale, float(x))] = {k: (v if k=='percentiles' else v[i]) for k, v in res.items()}
+   return out
 
-   p = np.mean(np.vstack(P), axis=0)
-   p = np.array(p/np.sum(p))
+# =========================================================
+class ResultCache(object):
+    """
+    on-disk store of dgs result dicts, one small .npz file per result, named
+    by a hash of the image bytes, the analysis parameters and __version__.
+    Once the files exceed max_bytes the least recently used are removed.
+    Pass an instance as dgs(..., cache=ResultCache('dgs_cache'))
+    """
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._nbytes = None
+        os.makedirs(directory, exist_ok=True)
 
-   scales = np.array(period)#*resolution
+    def key(self, data, **params):
+        """
+        returns the key for the image bytes data analysed with params
+        """
+        h = hashlib.sha256(data)
+        h.update(json.dumps({k: np.asarray(v).tolist() for k, v in params.items()}, sort_keys=True).encode())
+        h.update(__version__.encode())
+        return h.hexdigest()
 
-   srt = np.sqrt(np.sum(p*((scales-np.mean(M))**2)))
+    def _path(self, key):
+        return os.path.join(self.directory, key+'.npz')
 
-   # plt.plot(scales, p,'m', lw=2)
+    def get(self, key):
+        """
+        returns the stored result dict for key, or None
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as dat:
+                res = {k: dat[k] for k in dat.files}
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        for k in ('mean grain size', 'grain size sorting', 'grain size skewness', 'grain size kurtosis'):
+            res[k] = res[k][()]
+        res['percentiles'] = res['percentiles'].tolist()
+        return res
 
-   p = p+stats.norm.pdf(scales, np.mean(M), srt/2)
-   p = np.hstack([0,p])
-   scales = np.hstack([0,scales])
-   p = p/np.sum(p)
+    def put(self, key, res):
+        """
+        stores the result dict res under key, then evicts old entries if needed
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fid:
+            np.savez(fid, **{k: np.asarray(v) for k, v in res.items()})
+        os.replace(tmp, self._path(key))
 
-   ind = np.where(p>0)
-   p = p[ind]
-   scales = scales[ind]
+        if self._nbytes is None:
+            self._nbytes = self.info()['nbytes']
+        else:
+            self._nbytes += os.path.getsize(self._path(key))
+        if self._nbytes > self.max_bytes:
+            self.prune()
 
-   # area-by-number to volume-by-number
-   r_v = (p*scales**x) / np.sum(p*scales**x) #volume-by-weight proportion
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        return sorted(entries)
 
-   # get real scales by multiplying by resolution (mm/pixel)
-   scales = np.array(period)*resolution
+    def info(self):
+        """
+        returns a dict of the number of entries, their total size in bytes,
+        the size limit, and the hits and misses of this instance
+        """
+        entries = self._entries()
+        return {'entries': len(entries), 'nbytes': sum(e[1] for e in entries),
+                'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
 
-   # ======= stage 5 ==========================
-   # calc particle size stats
+    def prune(self, max_bytes=None):
+        """
+        removes least recently used entries until the cache is no larger
+        than max_bytes (default self.max_bytes). Returns the number removed
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self._entries()
+        nbytes = sum(e[1] for e in entries)
+        removed = 0
+        for mtime, size, name in entries:
+            if nbytes <= max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            nbytes -= size
+            removed += 1
+        self._nbytes = nbytes
+        return removed
 
-   pd = np.interp([.05,.1,.16,.25,.3,.5,.75,.84,.9,.95],np.hstack((0,np.cumsum(r_v))), np.hstack((0,scales)) )
-   if verbose==1:
-      print("d50 = "+str(pd[5]))
+    def clear(self):
+        """
+        removes every entry
+        """
+        return self.prune(0)
 
-   mnsz = np.sum(r_v*scales)
-   if verbose==1:
-      print("mean size = "+str(mnsz))
+# =========================================================
+def _init_worker(blas_threads):
+    """
+    pins the number of BLAS/OpenMP threads used by a batch worker process
+    """
+    if blas_threads is None:
+        return
+    # numpy, and so BLAS, is loaded before this runs (it is imported with
+    # dgs), so the environment is too late: limit the loaded libraries
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(blas_threads)
+    except ImportError:
+        pass
 
-   srt = np.sqrt(np.sum(r_v*((scales-mnsz)**2)))
-   if verbose==1:
-      print("stdev = "+str(srt))
+# =========================================================
+def _worker_pool(workers, blas_threads=1):
+    """
+    a ProcessPoolExecutor of workers processes, each using blas_threads
+    BLAS/OpenMP threads (None leaves them alone). threadpoolctl limits the
+    libraries a worker has loaded. Without it, the thread-count variables
+    are set in this process's environment, which workers that start a
+    fresh interpreter (spawn, forkserver) read when they load numpy, but
+    forked workers share the libraries this process loaded, so a warning
+    is given that the limit cannot be applied
+    """
+    if blas_threads is not None:
+        try:
+            import threadpoolctl
+        except ImportError:
+            for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                        'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS'):
+                os.environ[var] = str(blas_threads)
+            if multiprocessing.get_start_method() == 'fork':
+                warnings.warn('blas_threads=%s cannot be applied to forked workers without threadpoolctl '
+                              '(pip install threadpoolctl)' % blas_threads)
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(blas_threads,))
 
-   sk = (sum(r_v*((scales-mnsz)**3)))/(100*srt**3)
-   if verbose==1:
-      print("skewness = "+str(sk))
+# =========================================================
+class _Records(list):
+    """
+    profile or spectra callback used in batch workers, collecting the stage
+    records or spectra so they can be returned to the parent process
+    """
+    def __init__(self, trace_memory=False):
+        list.__init__(self)
+        self.trace_memory = trace_memory
 
-   kurt = (sum(r_v*((scales-mnsz)**4)))/(100*srt**4)
-   if verbose==1:
-      print("kurtosis = "+str(kurt))
+    def __call__(self, record):
+        self.append(record)
+
+# =========================================================
+def _batch_kwargs(resolution, maxscale, verbose, x, f, engine, cache, profile, options):
+    """
+    dgs keyword arguments sent to batch workers; profile and spectra
+    callbacks stay in this process and workers are only told whether to
+    trace memory and collect spectra
+    """
+    kwargs = dict(options, resolution=resolution, maxscale=maxscale, verbose=verbose,
+                  x=x, f=f, engine=engine, cache=cache,
+                  profile=None if profile is None else bool(getattr(profile, 'trace_memory', False)))
+    if options.get('spectra') is not None:
+        kwargs['spectra'] = True
+    return kwargs
 
-   # plt.plot(scales, r_v,'k', lw=2); plt.show()
+# =========================================================
+def _forward(records, spectra, profile, store):
+    """
+    hands the stage records and spectra sent back by a batch worker to the
+    profile and spectra callbacks of this process
+    """
+    for record in records:
+        profile(record)
+    for spectrum in spectra:
+        store(spectrum)
 
-   # ======= stage 6 ==========================
-   # return a dict object of stats
-   return {'mean grain size': mnsz, 'grain size sorting': srt, 'grain size skewness': sk, 'grain size kurtosis': kurt, 'percentiles': [.05,.1,.16,.25,.3,.5,.75,.84,.9,.95], 'percentile_values': pd, 'grain size frequencies': r_v, 'grain size bins': scales}
+# =========================================================
+def _dgs_job(job):
+    """
+    runs dgs on one image for dgs_batch, returning (result, error, stage
+    records, spectra) so that one bad image cannot stop the batch
+    """
+    image, kwargs = job
+    records = []
+    spectra = []
+    if kwargs.get('profile') is not None:
+        records = _Records(kwargs['profile'])
+        kwargs = dict(kwargs, profile=records)
+    if kwargs.get('spectra'):
+        spectra = _Records()
+        kwargs = dict(kwargs, spectra=spectra)
+    try:
+        return dgs(image, **kwargs), None, list(records), list(spectra)
+    except Exception as e:
+        return None, '{}: {}'.format(type(e).__name__, e), list(records), list(spectra)
+
+# =========================================================
+def dgs_batch(images, resolution=1, maxscale=4, verbose=0, x=-0.5, f=0, engine='pywt',
+              workers=None, chunksize=1, blas_threads=1, cache=None, profile=None, **options):
+    """
+    runs dgs on each of a list of images over a pool of worker processes
+    and returns the result dicts in the same order as images. An image that
+    fails is reported and gets None in place of its dict.
+    workers = number of processes (default os.cpu_count(); 1 runs in this process)
+    chunksize = number of images sent to a worker at a time
+    blas_threads = BLAS/OpenMP threads per worker (None leaves them alone)
+    cache = optional ResultCache, so that images already analysed with the
+            same parameters are not recomputed
+    profile = optional callback (e.g. a StageProfiler) called in this
+              process with the stage timings of every image
+    any other keyword arguments (e.g. nrows, tol) are passed on to dgs; a
+    spectra callback (e.g. a SpectrumStore) is called in this process and
+    flushed at the end
+    """
+    kwargs = _batch_kwargs(resolution, maxscale, verbose, x, f, engine, cache, profile, options)
+    jobs = [(image, kwargs) for image in images]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(int(workers), len(jobs)))
+
+    if workers == 1:
+        out = [_dgs_job(job) for job in tqdm(jobs)]
+    else:
+        with _worker_pool(workers, blas_threads) as pool:
+            out = list(tqdm(pool.map(_dgs_job, jobs, chunksize=chunksize), total=len(jobs)))
+
+    results = []
+    for image, (res, err, records, spectra) in zip(images, out):
+        if err is not None:
+            print('Failed to process '+str(image)+': '+err)
+        _forward(records, spectra, profile, options.get('spectra'))
+        results.append(res)
+    if hasattr(options.get('spectra'), 'flush'):
+        options['spectra'].flush()
+    return results
+
+# =========================================================
+def _dgs_chunk(jobs):
+    """
+    runs _dgs_job on a list of jobs in one worker call
+    """
+    return [_dgs_job(job) for job in jobs]
+
+# =========================================================
+def dgs_imap(images, resolution=1, maxscale=4, verbose=0, x=-0.5, f=0, engine='pywt',
+             workers=None, chunksize=1, blas_threads=1, cache=None, profile=None, **options):
+    """
+    generator version of dgs_batch: yields (image, result, error) for each
+    of images (any iterable) as soon as it is done, in completion order.
+    error is None on success, otherwise a message and result is None. Only
+    two chunks per worker are in flight at any time, so memory use does
+    not grow with the number of images
+    """
+    kwargs = _batch_kwargs(resolution, maxscale, verbose, x, f, engine, cache, profile, options)
+    images = iter(images)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for image in images:
+            res, err, records, spectra = _dgs_job((image, kwargs))
+            _forward(records, spectra, profile, options.get('spectra'))
+            yield image, res, err
+        if hasattr(options.get('spectra'), 'flush'):
+            options['spectra'].flush()
+        return
+
+    with _worker_pool(workers, blas_threads) as pool:
+        pending = {}
+        def submit():
+            chunk = list(islice(images, chunksize))
+            if chunk:
+                pending[pool.submit(_dgs_chunk, [(image, kwargs) for image in chunk])] = chunk
+            return bool(chunk)
+
+        for _ in range(2*workers):
+            if not submit():
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                chunk = pending.pop(fut)
+                for image, (res, err, records, spectra) in zip(chunk, fut.result()):
+                    _forward(records, spectra, profile, options.get('spectra'))
+                    yield image, res, err
+                submit()
+    if hasattr(options.get('spectra'), 'flush'):
+        options['spectra'].flush()
+
+# =========================================================
+def _columnar(images, results, mask=None):
+    """
+    packs dgs result dicts into flat arrays: one row of stats and of
+    percentile values per image, and the ragged frequencies and bins
+    concatenated, image i owning [offsets[i]:offsets[i+1]]. results can
+    also be the padded dict of grain_size_stats, with its mask
+    """
+    if isinstance(results, dict):
+        mask = results['grain size frequencies'] > 0 if mask is None else np.asarray(mask, dtype=bool)
+        return {'files': np.array([str(i) for i in images], dtype=str),
+                'stats': np.column_stack([results[k] for k in _STATS]).astype(float),
+                'percentiles': np.array(_PERCENTILES),
+                'percentile_values': np.asarray(results['percentile_values'], dtype=float),
+                'offsets': np.hstack((0, np.cumsum(np.sum(mask, axis=1)))).astype(np.int64),
+                'grain size frequencies': results['grain size frequencies'][mask],
+                'grain size bins': results['grain size bins'][mask]}
+    nbins = [len(r['grain size bins']) for r in results]
+    return {'files': np.array([str(i) for i in images], dtype=str),
+            'stats': np.array([[r[k] for k in _STATS] for r in results], dtype=float).reshape(-1, len(_STATS)),
+            'percentiles': np.array(_PERCENTILES),
+            'percentile_values': np.array([r['percentile_values'] for r in results], dtype=float).reshape(-1, len(_PERCENTILES)),
+            'offsets': np.hstack((0, np.cumsum(nbins))).astype(np.int64),
+            'grain size frequencies': np.hstack([np.zeros(0)]+[r['grain size frequencies'] for r in results]),
+            'grain size bins': np.hstack([np.zeros(0)]+[r['grain size bins'] for r in results])}
+
+# =========================================================
+def _from_columnar(cols, i):
+    """
+    unpacks the result dict of image i from _columnar arrays
+    """
+    a, b = cols['offsets'][i], cols['offsets'][i+1]
+    res = {k: cols['stats'][i, n] for n, k in enumerate(_STATS)}
+    res['percentiles'] = cols['percentiles'].tolist()
+    res['percentile_values'] = np.array(cols['percentile_values'][i])
+    res['grain size frequencies'] = np.array(cols['grain size frequencies'][a:b])
+    res['grain size bins'] = np.array(cols['grain size bins'][a:b])
+    return res
+
+# =========================================================
+class ResultStore(object):
+    """
+    append-only store of dgs results: a directory of chunk files
+    (part-00000.npz, ...) holding up to chunk results each, in the columnar
+    layout of _columnar. Chunks are written atomically, so a crash loses at
+    most the results not yet flushed, and done() lists the images already
+    stored so that a rerun can skip them. Several processes can append to
+    the same store without overwriting each other's chunks
+    """
+    def __init__(self, directory, chunk=256):
+        self.directory = directory
+        self.chunk = chunk
+        self._images = []
+        self._results = []
+        os.makedirs(directory, exist_ok=True)
+
+    def parts(self):
+        """
+        returns the paths of the chunk files, in the order they were written
+        """
+        parts = [p for p in os.listdir(self.directory) if p.startswith('part-') and p.endswith('.npz')]
+        return [os.path.join(self.directory, p) for p in sorted(parts, key=lambda p: int(p[5:-4]))]
+
+    def _write_part(self, arrays):
+        """
+        writes the dict of arrays as the next chunk file. The chunk is
+        written in full under a temporary name and then linked to the first
+        free part name, which fails rather than overwrites if another
+        process took that name first, so several processes can append to
+        one store
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fid:
+                np.savez(fid, **arrays)
+            parts = self.parts()
+            n = int(os.path.basename(parts[-1])[5:-4]) + 1 if parts else 0
+            while True:
+                try:
+                    os.link(tmp, os.path.join(self.directory, 'part-%05d.npz' % n))
+                    break
+                except FileExistsError:
+                    n += 1
+        finally:
+            os.remove(tmp)
+
+    def done(self):
+        """
+        returns the set of images with a stored result
+        """
+        done = set()
+        for part in self.parts():
+            with np.load(part) as dat:
+                done.update(dat['files'].tolist())
+        return done | set(str(i) for i in self._images)
+
+    def append(self, image, res):
+        """
+        adds the result dict res for image, writing a chunk when chunk results are waiting
+        """
+        self._images.append(image)
+        self._results.append(res)
+        if len(self._results) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        """
+        writes any results waiting in memory as a new chunk file
+        """
+        if not self._results:
+            return
+        self._write_part(_columnar(self._images, self._results))
+        self._images = []
+        self._results = []
+
+    def __iter__(self):
+        """
+        yields (image, result dict) for every stored result, one chunk in memory at a time
+        """
+        for part in self.parts():
+            with np.load(part) as dat:
+                cols = {k: dat[k] for k in dat.files}
+            for i, image in enumerate(cols['files']):
+                yield str(image), _from_columnar(cols, i)
+
+    def consolidate(self, path):
+        """
+        writes every stored result to path as one result set (see
+        save_results), reading one chunk at a time
+        """
+        self.flush()
+        def chunks():
+            for part in self.parts():
+                with np.load(part) as dat:
+                    yield {k: dat[k] for k in dat.files}
+        _write_columnar(path, chunks)
+
+# =========================================================
+def _write_columnar(path, chunks):
+    """
+    writes the _columnar arrays yielded by chunks() to the directory path as
+    one .npy file per column, sizing the files on a first pass over the
+    chunks and filling them on a second, so only one chunk is in memory
+    """
+    nimages = 0; nbins = 0; namelen = 1
+    for cols in chunks():
+        nimages += len(cols['files'])
+        nbins += int(cols['offsets'][-1])
+        namelen = max(namelen, cols['files'].dtype.itemsize//4)
+
+    os.makedirs(path, exist_ok=True)
+    def column(name, dtype, shape):
+        return np.lib.format.open_memmap(os.path.join(path, name+'.npy'), mode='w+', dtype=dtype, shape=shape)
+    out = {'files': column('files', '<U%d' % namelen, (nimages,)),
+           'stats': column('stats', float, (nimages, len(_STATS))),
+           'percentile_values': column('percentile_values', float, (nimages, len(_PERCENTILES))),
+           'offsets': column('offsets', np.int64, (nimages+1,)),
+           'grain size frequencies': column('grain size frequencies', float, (nbins,)),
+           'grain size bins': column('grain size bins', float, (nbins,))}
+
+    i = 0; b = 0
+    out['offsets'][0] = 0
+    for cols in chunks():
+        n = len(cols['files']); m = int(cols['offsets'][-1])
+        for k in ('files', 'stats', 'percentile_values'):
+            out[k][i:i+n] = cols[k]
+        out['offsets'][i+1:i+n+1] = cols['offsets'][1:] + b
+        for k in ('grain size frequencies', 'grain size bins'):
+            out[k][b:b+m] = cols[k]
+        i += n; b += m
+    for arr in out.values():
+        arr.flush()
+    del out
+
+    np.save(os.path.join(path, 'percentiles.npy'), np.array(_PERCENTILES))
+    with open(os.path.join(path, 'columns.json'), 'w') as fid:
+        json.dump({'version': __version__, 'stats': _STATS, 'images': nimages}, fid)
+
+# =========================================================
+def save_results(path, images, results, mask=None):
+    """
+    writes dgs result dicts for images to the directory path in a binary
+    columnar layout, one .npy file per column: files, stats (one row per
+    image, columns as in columns.json), percentiles, percentile_values,
+    and the frequencies and bins of all images concatenated, with image i
+    owning [offsets[i]:offsets[i+1]]. results can also be the output of
+    grain_size_stats, with its mask. Read it back with load_results
+    """
+    _write_columnar(path, lambda: [_columnar(images, results, mask)])
+
+# =========================================================
+def load_results(path, mmap=True):
+    """
+    reads a result set written by save_results (or ResultStore.consolidate)
+    into a dict of arrays in the same layout, memory-mapped unless mmap is
+    False so that millions of distributions can be sliced without loading
+    them. The result dict of image i is result_dict(cols, i)
+    """
+    mode = 'r' if mmap else None
+    cols = {}
+    for k in ('files', 'stats', 'percentiles', 'percentile_values', 'offsets',
+              'grain size frequencies', 'grain size bins'):
+        cols[k] = np.load(os.path.join(path, k+'.npy'), mmap_mode=mode)
+    return cols
+
+# =========================================================
+def result_dict(cols, i):
+    """
+    returns the dgs result dict of image i from a loaded result set
+    """
+    return _from_columnar(cols, i)
+
+# =========================================================
+def _pack_spectra(spectra):
+    """
+    packs spectrum dicts (see _dgs_image) into flat arrays: the ragged p
+    and M of all spectra concatenated (offsets, m_offsets), and each
+    distinct scale grid (period, w) stored once, spectrum i using grid
+    grid[i] at [grid_offsets[g]:grid_offsets[g+1]]
+    """
+    grids = OrderedDict()
+    for sp in spectra:
+        grids.setdefault((sp['period'].tobytes(), np.asarray(sp['w'], dtype=float).tobytes()), sp)
+    keys = list(grids)
+    return {'files': np.array(['' if sp['image'] is None else str(sp['image']) for sp in spectra], dtype=str),
+            'mbar': np.array([sp['mbar'] for sp in spectra], dtype=float),
+            'offsets': np.hstack((0, np.cumsum([len(sp['p']) for sp in spectra]))).astype(np.int64),
+            'p': np.hstack([np.zeros(0)]+[sp['p'] for sp in spectra]),
+            'm_offsets': np.hstack((0, np.cumsum([len(sp['M']) for sp in spectra]))).astype(np.int64),
+            'M': np.hstack([np.zeros(0)]+[sp['M'] for sp in spectra]),
+            'grid': np.array([keys.index((sp['period'].tobytes(), np.asarray(sp['w'], dtype=float).tobytes()))
+                              for sp in spectra], dtype=np.int64),
+            'grid_offsets': np.hstack((0, np.cumsum([len(grids[k]['period']) for k in keys]))).astype(np.int64),
+            'period': np.hstack([np.zeros(0)]+[grids[k]['period'] for k in keys]),
+            'w': np.hstack([np.zeros(0)]+[np.asarray(grids[k]['w'], dtype=float) for k in keys])}
+
+# =========================================================
+class SpectrumStore(ResultStore):
+    """
+    append-only store of the spectra behind dgs results: for each image the
+    normalised mean wavelet power in each bin p, the row-wise peak periods M
+    and their mean mbar, and the scale grid (periods and bin widths w).
+    These are all that the statistics depend on, so recalibrate can
+    recompute them for any x and resolution without the wavelet transform.
+    Pass an instance as dgs(..., spectra=SpectrumStore('spectra')) (or to
+    dgs_array, dgs_batch, dgs_imap, dgs_stream). Spectra are written in
+    chunk files (part-00000.npz, ...) of up to chunk spectra, each distinct
+    scale grid once per chunk; call flush() when done (the batch functions
+    do this themselves)
+    """
+    def __call__(self, spectrum):
+        """
+        adds a spectrum dict, writing a chunk when chunk spectra are waiting
+        """
+        self.append('' if spectrum['image'] is None else str(spectrum['image']), spectrum)
+
+    def flush(self):
+        """
+        writes any spectra waiting in memory as a new chunk file
+        """
+        if not self._results:
+            return
+        self._write_part(_pack_spectra(self._results))
+        self._images = []
+        self._results = []
+
+    def __iter__(self):
+        """
+        yields (image, spectrum dict) for every stored spectrum, one chunk in memory at a time
+        """
+        for part in self.parts():
+            with np.load(part) as dat:
+                cols = {k: dat[k] for k in dat.files}
+            for i, image in enumerate(cols['files']):
+                a, b = cols['offsets'][i], cols['offsets'][i+1]
+                g = cols['grid'][i]
+                yield str(image), {'image': str(image), 'p': cols['p'][a:b], 'mbar': cols['mbar'][i],
+                                   'M': cols['M'][cols['m_offsets'][i]:cols['m_offsets'][i+1]],
+                                   'period': cols['period'][cols['grid_offsets'][g]:cols['grid_offsets'][g+1]],
+                                   'w': cols['w'][cols['grid_offsets'][g]:cols['grid_offsets'][g+1]]}
+
+    def consolidate(self, path, x=-0.5, resolution=1):
+        """
+        writes the results for x and resolution of every stored spectrum to
+        path as one result set (see recalibrate)
+        """
+        recalibrate(self, x, resolution, out=path)
+
+    def load(self):
+        """
+        returns every stored spectrum as one dict of arrays in the layout of
+        _pack_spectra, with the scale grids of all chunks merged
+        """
+        self.flush()
+        chunks = []
+        for part in self.parts():
+            with np.load(part) as dat:
+                chunks.append({k: dat[k] for k in dat.files})
+        if not chunks:
+            return _pack_spectra([])
+
+        # merge the grids of the chunks, keeping one copy of each
+        grids = OrderedDict(); remap = []
+        for cols in chunks:
+            go = cols['grid_offsets']
+            ids = []
+            for g in range(len(go)-1):
+                period, w = cols['period'][go[g]:go[g+1]], cols['w'][go[g]:go[g+1]]
+                ids.append(grids.setdefault((period.tobytes(), w.tobytes()), (len(grids), period, w))[0])
+            remap.append(np.array(ids, dtype=np.int64))
+        out = {'files': np.hstack([cols['files'] for cols in chunks]),
+               'mbar': np.hstack([cols['mbar'] for cols in chunks]),
+               'grid': np.hstack([ids[cols['grid']] for ids, cols in zip(remap, chunks)])}
+        for k, off in (('p', 'offsets'), ('M', 'm_offsets')):
+            out[k] = np.hstack([cols[k] for cols in chunks])
+            out[off] = np.hstack([0]+[cols[off][1:] + n for cols, n in
+                                      zip(chunks, np.cumsum([0]+[c[off][-1] for c in chunks[:-1]]))]).astype(np.int64)
+        grids = list(grids.values())
+        out['grid_offsets'] = np.hstack((0, np.cumsum([len(g[1]) for g in grids]))).astype(np.int64)
+        out['period'] = np.hstack([g[1] for g in grids])
+        out['w'] = np.hstack([g[2] for g in grids])
+        return out
+
+# =========================================================
+def recalibrate(spectra, x=-0.5, resolution=1, out=None):
+    """
+    recomputes the dgs statistics of every spectrum in spectra (a
+    SpectrumStore, its directory, or the dict returned by its load()) for
+    the area-by-number to volume-by-number coefficient x and resolution
+    (scalars, or one value per spectrum in store order), without redoing
+    the wavelet transforms. The statistics of all spectra on the same scale
+    grid are computed together, so thousands of images take seconds.
+    Returns the result set as a dict of arrays in the layout of
+    load_results (result_dict(cols, i) gives the dgs dict of spectrum i),
+    also written to the directory out if given. Results are identical to
+    rerunning dgs with the new x and resolution
+    """
+    if isinstance(spectra, str):
+        spectra = SpectrumStore(spectra)
+    if isinstance(spectra, SpectrumStore):
+        spectra = spectra.load()
+
+    n = len(spectra['files'])
+    x = np.broadcast_to(np.asarray(x, dtype=float), (n,))
+    resolution = np.broadcast_to(np.asarray(resolution, dtype=float), (n,))
+    stats_ = np.empty((n, len(_STATS)))
+    pv = np.empty((n, len(_PERCENTILES)))
+    freqs = [None]*n; bins = [None]*n
+
+    go = spectra['grid_offsets']
+    for g in range(len(go)-1):
+        idx = np.flatnonzero(spectra['grid']==g)
+        if len(idx)==0:
+            continue
+        period = spectra['period'][go[g]:go[g+1]]
+        w = spectra['w'][go[g]:go[g+1]]
+        p = spectra['p'][spectra['offsets'][idx][:,None] + np.arange(len(period))]
+        res = _grain_size_stats_many(p, spectra['mbar'][idx], period, x[idx], resolution[idx], w)
+        stats_[idx] = np.column_stack([res[k] for k in _STATS])
+        pv[idx] = res['percentile_values']
+        # empty bins are left out, as in dgs
+        keep = res['grain size frequencies'] > 0
+        for k, i in enumerate(idx):
+            freqs[i] = res['grain size frequencies'][k][keep[k]]
+            bins[i] = res['grain size bins'][k][keep[k]]
+
+    cols = {'files': np.asarray(spectra['files'], dtype=str), 'stats': stats_,
+            'percentiles': np.array(_PERCENTILES), 'percentile_values': pv,
+            'offsets': np.hstack((0, np.cumsum([len(f) for f in freqs]))).astype(np.int64),
+            'grain size frequencies': np.hstack([np.zeros(0)]+freqs),
+            'grain size bins': np.hstack([np.zeros(0)]+bins)}
+    if out is not None:
+        _write_columnar(out, lambda: [cols])
+    return cols
+
+# =========================================================
+def dgs_stream(images, store, resolution=1, maxscale=4, verbose=0, x=-0.5, f=0, engine='pywt',
+               workers=None, chunksize=1, blas_threads=1, cache=None, profile=None, **options):
+    """
+    streaming batch mode: runs dgs_imap over the images not already in
+    store (a ResultStore or a directory name), appending each result to the
+    store as it completes and yielding (image, result, error). Rerunning
+    the same call after an interruption resumes where it stopped
+    """
+    if not isinstance(store, ResultStore):
+        store = ResultStore(store)
+    done = store.done()
+    todo = (image for image in images if str(image) not in done)
+    try:
+        for image, res, err in dgs_imap(todo, resolution, maxscale, verbose, x, f, engine,
+                                        workers, chunksize, blas_threads, cache, profile, **options):
+            if err is None:
+                store.append(image, res)
+            yield image, res, err
+    finally:
+        store.flush()
+
+# =========================================================
+def shard_of(image, shards):
+    """
+    returns the shard (0 to shards-1) that image belongs to, from a hash of
+    its name, so every node agrees on it whatever the order or number of
+    the other images
+    """
+    return int(hashlib.md5(str(image).encode('utf-8')).hexdigest()[:15], 16) % shards
+
+# =========================================================
+def shard_images(images, index, shards):
+    """
+    returns the images of shard index of shards, in their original order
+    """
+    if not 0 <= index < shards:
+        raise ValueError('shard index must be between 0 and %i' % (shards-1))
+    return [image for image in images if shard_of(image, shards) == index]
+
+# =========================================================
+def _write_json(path, obj):
+    """
+    writes obj to the json file path atomically
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'w') as fid:
+        json.dump(obj, fid, indent=1)
+    os.replace(tmp, path)
+
+# =========================================================
+def dgs_shard(images, directory, index, shards, resolution=1, maxscale=4, verbose=0, x=-0.5, f=0, engine='pywt',
+              workers=None, chunksize=1, blas_threads=1, cache=None, profile=None, **options):
+    """
+    runs shard index of shards: analyses its share of images (see
+    shard_images) with dgs_stream into the ResultStore
+    directory/shard-IIII-of-NNNN, and describes it in shard.json there
+    (shard, shards, parameters, version, host, the images assigned and
+    those that failed, and whether it ran to the end). Every shard of a
+    batch is given the same images and directory, on any number of
+    processes or nodes sharing the directory, and merge_shards combines
+    them. Rerunning a shard resumes it, and refuses different parameters.
+    Returns the shard description
+    """
+    mine = [str(image) for image in shard_images(images, index, shards)]
+    path = os.path.join(directory, 'shard-%04d-of-%04d' % (index, shards))
+    store = ResultStore(path)
+
+    # results are only mergeable if every shard used the same parameters
+    params = dict(options, resolution=resolution, maxscale=maxscale, x=x, f=f, engine=engine)
+    params.pop('spectra', None)
+    params = json.loads(json.dumps(params, sort_keys=True, default=str))
+    pfile = os.path.join(path, 'shard.json')
+    if os.path.exists(pfile):
+        with open(pfile) as fid:
+            used = json.load(fid)
+        if used['params'] != params or used['version'] != __version__:
+            raise ValueError('shard '+path+' was made with different parameters: '+str(used['params']))
+
+    info = {'shard': index, 'shards': shards, 'params': params, 'version': __version__,
+            'host': platform.node(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'finished': None,
+            'complete': False, 'images': mine, 'failed': []}
+    _write_json(pfile, info)
+
+    failed = [image for image, res, err in dgs_stream(mine, store, resolution, maxscale, verbose, x, f, engine,
+                                                      workers, chunksize, blas_threads, cache, profile, **options)
+              if err is not None]
+
+    info.update(finished=time.strftime('%Y-%m-%dT%H:%M:%S'), complete=True, failed=failed)
+    _write_json(pfile, info)
+    return info
+
+# =========================================================
+def _select_columnar(cols, keep):
+    """
+    returns the rows of _columnar arrays where the boolean array keep is True
+    """
+    nbins = np.diff(cols['offsets'])
+    out = {k: cols[k][keep] for k in ('files', 'stats', 'percentile_values')}
+    out['percentiles'] = cols['percentiles']
+    out['offsets'] = np.hstack((0, np.cumsum(nbins[keep]))).astype(np.int64)
+    for k in ('grain size frequencies', 'grain size bins'):
+        out[k] = cols[k][np.repeat(keep, nbins)]
+    return out
+
+# =========================================================
+def _scale_columnar(cols, resolution):
+    """
+    _columnar arrays of results computed in pixels converted to the units
+    of resolution. The mean, sorting, percentile values and bins scale with
+    it, and skewness, kurtosis and frequencies do not, so this is exact
+    (recomputing with grain_size_stats would lose the placement of the
+    percentiles of grids other than 'linear', see _cdf_sizes)
+    """
+    out = dict(cols)
+    out['stats'] = cols['stats'] * np.array([resolution, resolution, 1, 1])
+    out['percentile_values'] = cols['percentile_values'] * resolution
+    out['grain size bins'] = cols['grain size bins'] * resolution
+    return out
+
+# =========================================================
+def merge_shards(directory, path, images=None, resolution=1):
+    """
+    combines the shards written by dgs_shard in directory into one result
+    set at path (see save_results), with resolution applied to results
+    computed in pixels. An image stored more than once (e.g. a shard run
+    twice at the same time) is kept once. images (the full list the batch
+    was given, optional) also catches images of shards that never ran.
+    Returns a report, also written to path/merge.json: shards found,
+    missing and incomplete, duplicate images, failed images and missing
+    images (with no result and not reported as failed)
+    """
+    shards = []
+    for pfile in sorted(glob.glob(os.path.join(directory, 'shard-*-of-*', 'shard.json'))):
+        with open(pfile) as fid:
+            shards.append(json.load(fid))
+    if not shards:
+        raise ValueError('no shards in '+directory)
+    first = shards[0]
+    for info in shards[1:]:
+        if info['shards'] != first['shards']:
+            raise ValueError('%s holds shards of both a %i-way and a %i-way split' % (directory, first['shards'], info['shards']))
+        if info['params'] != first['params'] or info['version'] != first['version']:
+            raise ValueError('shards %i and %i were made with different parameters' % (first['shard'], info['shard']))
+
+    n = first['shards']
+    found = [info['shard'] for info in shards]
+    expected = [str(image) for image in images] if images is not None else [i for info in shards for i in info['images']]
+    stores = [ResultStore(os.path.join(directory, 'shard-%04d-of-%04d' % (k, n))) for k in found]
+
+    # first pass: which stored results to keep
+    seen = set(); duplicates = []; keeps = []
+    for store in stores:
+        for part in store.parts():
+            with np.load(part) as dat:
+                files = dat['files'].tolist()
+            keep = np.ones(len(files), dtype=bool)
+            for i, image in enumerate(files):
+                if image in seen:
+                    keep[i] = False
+                    duplicates.append(image)
+                seen.add(image)
+            keeps.append((part, keep))
+
+    def chunks():
+        for part, keep in keeps:
+            with np.load(part) as dat:
+                cols = _select_columnar({k: dat[k] for k in dat.files}, keep)
+            yield cols if resolution == 1 else _scale_columnar(cols, resolution)
+    _write_columnar(path, chunks)
+
+    failed = [i for info in shards for i in info['failed']]
+    reported = set(failed)
+    report = {'shards': n, 'found': found,
+              'missing shards': sorted(set(range(n)) - set(found)),
+              'incomplete shards': [info['shard'] for info in shards if not info['complete']],
+              'images': len(seen),
+              'duplicates': sorted(set(duplicates)),
+              'failed': failed,
+              'missing': [i for i in dict.fromkeys(expected) if i not in seen and i not in reported],
+              'params': first['params'], 'version': first['version'], 'resolution': resolution}
+    _write_json(os.path.join(path, 'merge.json'), report)
+    return report
+
+# =========================================================
+class _Frames(object):
+    """
+    random access to the frames of source, read lazily: a video or
+    multi-frame file (through imageio.get_reader), an image sequence (a
+    list of files, a glob pattern or a folder, in sorted order) or any
+    iterable of arrays. get(i) returns frame i and raises IndexError past
+    the end; frames before i that were not asked for are skipped, without
+    decoding where the reader can seek
+    """
+    IMAGE_TYPES = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+    def __init__(self, source):
+        self.fps = None
+        self._files = self._reader = self._iter = None
+        if isinstance(source, str) and os.path.isdir(source):
+            self._files = sorted(os.path.join(source, n) for n in os.listdir(source)
+                                 if n.lower().endswith(self.IMAGE_TYPES))
+        elif isinstance(source, str) and any(c in source for c in '*?['):
+            self._files = sorted(glob.glob(source))
+        elif isinstance(source, str):
+            self._reader = imageio.get_reader(source)
+            try:
+                self.fps = self._reader.get_meta_data().get('fps')
+            except Exception:
+                # not every plugin has file-level metadata
+                pass
+        elif isinstance(source, (list, tuple)) and all(isinstance(s, str) for s in source):
+            self._files = list(source)
+        else:
+            self._iter = iter(source)
+            self._next = 0
+
+    def get(self, i):
+        if self._files is not None:
+            if i >= len(self._files):
+                raise IndexError(i)
+            return imread(self._files[i])
+        if self._reader is not None:
+            try:
+                return self._reader.get_data(i)
+            except (IndexError, StopIteration):
+                raise IndexError(i)
+        # an iterable can only be read in order
+        while self._next <= i:
+            try:
+                frame = next(self._iter)
+            except StopIteration:
+                raise IndexError(i)
+            self._next += 1
+        return frame
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+
+# =========================================================
+def dgs_frames(source, resolution=1, maxscale=4, x=-0.5, f=0, engine='fft', every=1, start=0, stop=None,
+               pace=False, fps=None, profile=None, **options):
+    """
+    streaming mode for time-lapse and video: yields (frame, time, result,
+    error) for the frames of source (a video file, image sequence or
+    iterable of arrays, see _Frames) as each is analysed, reading them one
+    at a time. Frames of one size share the wavelet filter bank. every=k
+    analyses every k-th frame from start (up to stop). With pace=True the
+    stream keeps up with acquisition: after each frame it skips ahead to
+    the frame being recorded at that moment, given fps (default: the frame
+    rate of the video), so results lag the camera by at most one analysis.
+    time is frame/fps in seconds (None without a frame rate); a frame that
+    cannot be analysed yields result None and the error message. options
+    are passed on to dgs_array (e.g. nrows, threads, sigma)
+    """
+    frames = _Frames(source)
+    fps = fps or frames.fps
+    if pace and not fps:
+        raise ValueError('pace needs the frame rate: pass fps')
+    t0 = time.perf_counter()
+    i = start
+    try:
+        while stop is None or i < stop:
+            try:
+                frame = frames.get(i)
+            except IndexError:
+                return
+            try:
+                res, err = dgs_array(frame, resolution, maxscale, 0, x, f, engine, profile, **options), None
+            except Exception as e:
+                res, err = None, '{}: {}'.format(type(e).__name__, e)
+            yield i, (i/fps if fps else None), res, err
+
+            nxt = i + every
+            if pace:
+                # the frame the camera is recording now
+                nxt = max(nxt, start + int((time.perf_counter() - t0)*fps))
+            i = nxt
+    finally:
+        frames.close()
+
+# =========================================================
+# arrays opened for tiled reading, kept per process so that each worker
+# maps a file once
+_TILE_SOURCES = {}
+
+def _open_tiled(source):
+    """
+    opens a large image for windowed reading without loading it. Arrays
+    (including np.memmap) are used as they are, .npy files are memory-mapped,
+    and TIFF files are memory-mapped with tifffile, or read window by window
+    through zarr when they are compressed or tiled
+    """
+    if isinstance(source, tuple):
+        # np.memmap passed to a worker process as (filename, dtype, shape, offset)
+        if source not in _TILE_SOURCES:
+            filename, dtype, shape, offset = source
+            _TILE_SOURCES[source] = np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset)
+        return _TILE_SOURCES[source]
+    if not isinstance(source, str):
+        return source
+    if source in _TILE_SOURCES:
+        return _TILE_SOURCES[source]
+
+    if source.lower().endswith('.npy'):
+        arr = np.load(source, mmap_mode='r')
+    elif source.lower().endswith(('.tif', '.tiff')):
+        try:
+            import tifffile
+        except ImportError:
+            raise ImportError('tiled reading of TIFF files requires the tifffile package')
+        try:
+            arr = tifffile.memmap(source, mode='r')
+        except ValueError:
+            # compressed or tiled TIFF: decode only the requested windows
+            try:
+                import zarr
+            except ImportError:
+                raise ImportError('compressed TIFF files require the zarr package for tiled reading '
+                                  '(or convert the mosaic to an uncompressed TIFF or .npy file)')
+            arr = zarr.open(tifffile.imread(source, aszarr=True), mode='r')
+    else:
+        raise ValueError('tiled sources must be arrays, .npy files or TIFF files, not '+source)
+
+    _TILE_SOURCES[source] = arr
+    return arr
+
+# =========================================================
+def _tile_job(job):
+    """
+    analyses one tile for dgs_tiles, returning (row, col, result, error)
+    """
+    source, i, j, r0, c0, tile, kwargs = job
+    try:
+        window = np.asarray(_open_tiled(source)[r0:r0+tile, c0:c0+tile])
+        if window.ndim==3 and window.shape[2]>4:
+            window = window[:,:,:3]
+        return i, j, dgs_array(window, verbose=0, **kwargs), None
+    except Exception as e:
+        return i, j, None, '{}: {}'.format(type(e).__name__, e)
+
+# =========================================================
+def dgs_tiles(source, tile=1024, step=None, resolution=1, maxscale=4, x=-0.5, f=0, engine='fft',
+              workers=None, blas_threads=1, out=None):
+    """
+    maps grain size over a large image by running dgs on square tiles read
+    lazily from source: an array or np.memmap, a .npy file, or a TIFF file
+    (grey, or colour with bands last). Only one tile per worker is ever in
+    memory. Tiles are tile pixels wide and start every step pixels (default
+    tile, i.e. no overlap); tiles that cannot be analysed (e.g. uniform
+    nodata areas) are NaN.
+    Returns a dict of rasters with one value per tile: the four moment
+    statistics as 2D arrays, 'percentile_values' as a 3D array with the
+    percentiles along the last axis, 'd50', and the pixel 'row' and 'col'
+    of each tile centre. If out is given the dict is also saved there
+    with np.savez
+    """
+    if step is None:
+        step = tile
+    arr = _open_tiled(source)
+    nrows, ncols = arr.shape[:2]
+    if nrows < tile or ncols < tile:
+        raise ValueError('image of size '+str((nrows,ncols))+' is smaller than one tile of '+str(tile))
+    r0s = np.arange(0, nrows - tile + 1, step)
+    c0s = np.arange(0, ncols - tile + 1, step)
+
+    if isinstance(arr, np.memmap) and not isinstance(source, str):
+        source = (arr.filename, arr.dtype.str, arr.shape, arr.offset)
+
+    kwargs = {'resolution': resolution, 'maxscale': maxscale, 'x': x, 'f': f, 'engine': engine}
+    jobs = [(source, i, j, r0, c0, tile, kwargs) for i, r0 in enumerate(r0s) for j, c0 in enumerate(c0s)]
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if not isinstance(source, (str, tuple)):
+        # an array in this process' memory cannot be shared with workers
+        workers = 1
+    workers = max(1, min(int(workers), len(jobs)))
+
+    raster = {k: np.full((len(r0s), len(c0s)), np.nan) for k in
+              ('mean grain size', 'grain size sorting', 'grain size skewness', 'grain size kurtosis')}
+    raster['percentile_values'] = np.full((len(r0s), len(c0s), len(_PERCENTILES)), np.nan)
+
+    if workers == 1:
+        results = map(_tile_job, jobs)
+    else:
+        pool = _worker_pool(workers, blas_threads)
+        results = pool.map(_tile_job, jobs, chunksize=max(1, len(jobs)//(4*workers)))
+    try:
+        for i, j, res, err in tqdm(results, total=len(jobs)):
+            if err is not None:
+                continue
+            for k in raster:
+                raster[k][i,j] = res[k]
+    finally:
+        if workers != 1:
+            pool.shutdown()
+
+    raster['d50'] = raster['percentile_values'][:,:,_PERCENTILES.index(.5)]
+    raster['percentiles'] = np.array(_PERCENTILES)
+    raster['row'] = r0s + tile/2.
+    raster['col'] = c0s + tile/2.
 
+    if out is not None:
+        np.savez(out, **raster)
+    return raster
 
 # =========================================================
 # =========================================================
@@ -0,0 +1,409 @@
+# Written by Dr Daniel Buscombe, Marda Science LLC
+#
+# MIT License
+#
+# Copyright (c) 2020-22, Marda Science LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from dgs import *
+from dgs import _worker_pool
+import os, io
+import sys, getopt
+import json, time, threading, queue, socket, socketserver
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl, urlencode
+from concurrent.futures import Future
+from collections import deque
+
+# dgs_array keyword arguments a request may set, and their types
+PARAMS = {'resolution': float, 'maxscale': int, 'x': float, 'f': int, 'engine': str, 'nrows': int,
+          'tol': float, 'grid': str, 'voices': int, 'dtype': str, 'sigma': float, 'denoise_rows': int}
+
+#================================================================
+def _to_json(res):
+    """
+    the dgs result dict with numpy values converted for json
+    """
+    return {k: v.tolist() if isinstance(v, np.ndarray) else v.item() if isinstance(v, np.generic) else v
+            for k, v in res.items()}
+
+#================================================================
+def _decode(body):
+    """
+    an image array from request bytes: a .npy array, or an encoded image
+    in any format imageio reads (jpeg, png, tiff, ...)
+    """
+    if body[:6] == b'\x93NUMPY':
+        return np.load(io.BytesIO(body), allow_pickle=False)
+    return imread(io.BytesIO(body))
+
+#================================================================
+def _analyse_batch(images, kwargs):
+    """
+    runs dgs_array on each of a batch of same-size images in a worker,
+    returning (result, error) for each so one bad image cannot fail the rest
+    """
+    out = []
+    for im in images:
+        try:
+            out.append((_to_json(dgs_array(im, verbose=0, **kwargs)), None))
+        except Exception as e:
+            out.append((None, '{}: {}'.format(type(e).__name__, e)))
+    return out
+
+#================================================================
+class DGSService(object):
+    """
+    keeps dgs warm for a stream of requests: images submitted from any
+    thread are queued, and a dispatcher collects up to max_batch of them
+    (waiting at most max_wait seconds after the first), groups those of
+    the same size and parameters, and splits each group into at most one
+    job per worker for a pool of worker processes, so every worker reuses
+    its imports and filter banks and a burst keeps all of them busy. workers=0 analyses the batches in the dispatcher thread.
+    defaults are the dgs_array parameters used when a request does not
+    give them. metrics() reports the queue depth, batch sizes and latencies
+    """
+    def __init__(self, workers=1, max_batch=16, max_wait=0.01, blas_threads=1, window=1000, **defaults):
+        self.defaults = dict({'resolution': 1, 'maxscale': 4, 'x': -0.5, 'f': 0, 'engine': 'fft'}, **defaults)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._pool = None
+        if workers > 0:
+            self._pool = _worker_pool(workers, blas_threads)
+        # at most two batches per worker in flight, so waiting requests stay in the queue
+        self._slots = threading.BoundedSemaphore(2*max(workers, 1))
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._counts = {'requests': 0, 'completed': 0, 'failed': 0, 'batches': 0, 'in flight': 0}
+        self._wait = deque(maxlen=window)
+        self._latency = deque(maxlen=window)
+        self._batch_sizes = deque(maxlen=window)
+        self._closed = False
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._thread.start()
+
+    def submit(self, im, **params):
+        """
+        queues the image array im for analysis with params (overriding the
+        defaults) and returns a Future for its result dict (as json types)
+        """
+        if self._closed:
+            raise RuntimeError('the service is closed')
+        kwargs = dict(self.defaults, **params)
+        if 'dtype' in kwargs:
+            kwargs['dtype'] = np.dtype(kwargs['dtype'])
+        future = Future()
+        with self._lock:
+            self._counts['requests'] += 1
+        self._queue.put((np.asarray(im), kwargs, future, time.perf_counter()))
+        return future
+
+    def analyse(self, im, timeout=None, **params):
+        """
+        submit(im, **params) and wait for the result dict
+        """
+        return self.submit(im, **params).result(timeout)
+
+    def _dispatch(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+
+            # group by image size and set of parameters; a job analyses its images
+            # one after another, so each group is spread over the workers
+            groups = {}
+            for job in batch:
+                key = (job[0].shape, job[0].dtype.str, repr(sorted(job[1].items())))
+                groups.setdefault(key, []).append(job)
+            for jobs in groups.values():
+                size = -(-len(jobs)//max(self.workers, 1))
+                for i in range(0, len(jobs), size):
+                    self._run(jobs[i:i+size])
+
+    def _run(self, jobs):
+        start = time.perf_counter()
+        with self._lock:
+            self._counts['batches'] += 1
+            self._counts['in flight'] += len(jobs)
+            self._batch_sizes.append(len(jobs))
+            self._wait.extend(start - job[3] for job in jobs)
+        images = [job[0] for job in jobs]
+        if self._pool is None:
+            self._finish(jobs, _analyse_batch(images, jobs[0][1]))
+            return
+        self._slots.acquire()
+        done = self._pool.submit(_analyse_batch, images, jobs[0][1])
+        done.add_done_callback(lambda done: self._collect(jobs, done))
+
+    def _collect(self, jobs, done):
+        self._slots.release()
+        try:
+            out = done.result()
+        except Exception as e:
+            # a crashed worker fails its whole batch
+            out = [(None, '{}: {}'.format(type(e).__name__, e))]*len(jobs)
+        self._finish(jobs, out)
+
+    def _finish(self, jobs, out):
+        end = time.perf_counter()
+        with self._lock:
+            self._counts['in flight'] -= len(jobs)
+            for job, (res, err) in zip(jobs, out):
+                self._counts['completed' if err is None else 'failed'] += 1
+                self._latency.append(end - job[3])
+        for job, (res, err) in zip(jobs, out):
+            if err is None:
+                job[2].set_result(res)
+            else:
+                job[2].set_exception(ValueError(err))
+
+    def metrics(self):
+        """
+        returns the queue depth (requests waiting for a batch), requests in
+        flight, request counts, uptime, the mean size of recent batches and
+        the median, 95th percentile and maximum of the recent queue wait
+        and total latency, in seconds
+        """
+        with self._lock:
+            out = dict(self._counts)
+            wait, latency, sizes = list(self._wait), list(self._latency), list(self._batch_sizes)
+        out['queue depth'] = self._queue.qsize()
+        out['workers'] = self.workers
+        out['uptime'] = time.time() - self._started
+        out['mean batch size'] = float(np.mean(sizes)) if sizes else 0.
+        for name, v in (('wait', wait), ('latency', latency)):
+            out[name] = ({'p50': float(np.percentile(v, 50)), 'p95': float(np.percentile(v, 95)), 'max': float(np.max(v))}
+                         if v else {'p50': 0., 'p95': 0., 'max': 0.})
+        return out
+
+    def close(self):
+        """
+        finishes the queued requests and stops the dispatcher and workers
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+#================================================================
+class _Handler(BaseHTTPRequestHandler):
+    """
+    POST /dgs?maxscale=10&x=0 with the image bytes (encoded image or .npy
+    array) as the body returns the dgs result dict as json; GET /metrics
+    returns the service metrics and GET /health returns ok
+    """
+    service = None
+    timeout_s = 600
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            self._reply(200, self.service.metrics())
+        elif path == '/health':
+            self._reply(200, {'status': 'ok'})
+        else:
+            self._reply(404, {'error': 'unknown path '+path})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/dgs':
+            self._reply(404, {'error': 'unknown path '+url.path})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            params = {k: PARAMS[k](v) for k, v in parse_qsl(url.query)}
+            im = _decode(body)
+        except KeyError as e:
+            self._reply(400, {'error': 'unknown parameter {}'.format(e)})
+            return
+        except Exception as e:
+            self._reply(400, {'error': '{}: {}'.format(type(e).__name__, e)})
+            return
+        try:
+            self._reply(200, self.service.analyse(im, self.timeout_s, **params))
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix socket'
+
+    def log_message(self, format, *args):
+        logger.info('%s - %s', self.address_string(), format % args)
+
+#================================================================
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+
+#================================================================
+def make_server(service, address=('127.0.0.1', 8765)):
+    """
+    an http server for service on address: (host, port), or the path of
+    a unix socket. Call serve_forever() on it (or run it in a thread)
+    """
+    handler = type('Handler', (_Handler,), {'service': service})
+    if isinstance(address, str):
+        return _UnixHTTPServer(address, handler)
+    return ThreadingHTTPServer(address, handler)
+
+#================================================================
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=600):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+#================================================================
+def _connect(address, timeout):
+    if isinstance(address, str):
+        return _UnixHTTPConnection(address, timeout)
+    return http.client.HTTPConnection(address[0], address[1], timeout=timeout)
+
+#================================================================
+def request_dgs(image, address=('127.0.0.1', 8765), timeout=600, **params):
+    """
+    client: sends image (a file name, encoded image bytes or an array) to
+    the service at address and returns the result dict, with the
+    percentiles, frequencies and bins as arrays. Raises RuntimeError if
+    the service reports an error
+    """
+    if isinstance(image, str):
+        with open(image, 'rb') as fid:
+            body = fid.read()
+    elif isinstance(image, bytes):
+        body = image
+    else:
+        buf = io.BytesIO()
+        np.save(buf, np.asarray(image), allow_pickle=False)
+        body = buf.getvalue()
+    conn = _connect(address, timeout)
+    try:
+        conn.request('POST', '/dgs?'+urlencode(params), body)
+        reply = conn.getresponse()
+        out = json.loads(reply.read())
+    finally:
+        conn.close()
+    if reply.status != 200:
+        raise RuntimeError(out['error'])
+    return {k: np.array(v) if isinstance(v, list) and k != 'percentiles' else v for k, v in out.items()}
+
+#================================================================
+def service_metrics(address=('127.0.0.1', 8765), timeout=10):
+    """
+    client: the metrics of the service at address
+    """
+    conn = _connect(address, timeout)
+    try:
+        conn.request('GET', '/metrics')
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+#================================================================
+def usage():
+    print('python dgs_service.py {-H host} {-p port} {-u unix socket path, instead of host and port} {-w worker processes (0 runs in the service process)} {-b largest batch} {-t longest wait for a batch to fill (ms)} {-r resolution} {-m maxscale} {-x "x" parameter} {-f filter (0 or 1)} {-e engine (pywt or fft)}')
+
+#====================================
+if __name__ == '__main__':
+
+    argv = sys.argv[1:]
+    try:
+        opts, args = getopt.getopt(argv,"hH:p:u:w:b:t:r:m:x:f:e:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    host = '127.0.0.1'; port = 8765; path = None
+    workers = os.cpu_count() or 1; max_batch = 16; max_wait = 0.01; defaults = {}
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            print('Example usage: python dgs_service.py -p 8765 -w 4 -m 10 -x 0')
+            print("  then: curl --data-binary @data/IMG_0229.JPG 'http://127.0.0.1:8765/dgs?maxscale=10'")
+            print('Example usage: python dgs_service.py -u /tmp/dgs.sock')
+            sys.exit()
+        elif opt in ("-H"):
+            host = arg
+        elif opt in ("-p"):
+            port = int(arg)
+        elif opt in ("-u"):
+            path = arg
+        elif opt in ("-w"):
+            workers = int(arg)
+        elif opt in ("-b"):
+            max_batch = int(arg)
+        elif opt in ("-t"):
+            max_wait = float(arg)/1000
+        elif opt in ("-r"):
+            defaults['resolution'] = float(arg)
+        elif opt in ("-m"):
+            defaults['maxscale'] = int(arg)
+        elif opt in ("-x"):
+            defaults['x'] = float(arg)
+        elif opt in ("-f"):
+            defaults['f'] = int(arg)
+        elif opt in ("-e"):
+            defaults['engine'] = arg
+
+    service = DGSService(workers, max_batch, max_wait, **defaults)
+    server = make_server(service, path or (host, port))
+    print('dgs service on '+(path or 'http://%s:%i' % (host, port))+' with %i workers' % workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
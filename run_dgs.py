@@ -23,74 +23,127 @@
 # SOFTWARE.
 
 from dgs import *
+from dgs import __version__
 import os, glob
 import sys, getopt
+import json, time
 import pandas as pd
 import matplotlib.pyplot as plt
 plt.style.use('fivethirtyeight')
-from tkinter import Tk
-from tkinter.filedialog import askopenfilename, askdirectory
 from datetime import datetime
 
+IMAGE_TYPES = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+
+#================================================================
+def find_images(inputs, manifest=None):
+   """
+   expands inputs (image files, glob patterns, which may use ** to search
+   subfolders, and folders, searched recursively for image files) and the
+   lines of an optional manifest file (one image per line, relative to the
+   manifest, # for comments) into a list of images without duplicates
+   """
+   inputs = list(inputs)
+   if manifest:
+      with open(manifest) as fid:
+         root = os.path.dirname(manifest)
+         inputs += [os.path.join(root, line.strip()) for line in fid if line.strip() and not line.strip().startswith('#')]
+
+   files = []
+   for item in inputs:
+      if os.path.isdir(item):
+         for folder, dirs, names in os.walk(item):
+            dirs.sort()
+            files += [os.path.join(folder, n) for n in sorted(names) if n.lower().endswith(IMAGE_TYPES)]
+      elif any(c in item for c in '*?['):
+         files += sorted(f for f in glob.glob(item, recursive=True) if os.path.isfile(f))
+      else:
+         files.append(item)
+   return list(dict.fromkeys(files))
+
 #================================================================
-def do_dgs(resolution, maxscale, x, verbose, files, f):
-
-   ALL_RES = []
-   for f in tqdm(files): #tqdm gives you a progress bar
-      data_out = dgs(f, 1, maxscale, verbose, x, f)
-      ALL_RES.append(data_out)
-
-   ## parse out dict into three separate dictionaries
-   S = {}; P = {}; F = {}
-   counter = 0
-   for data_out in ALL_RES:
-      stats = dict(list(data_out.items())[:4])
-      percentiles = dict(list(data_out.items())[4:6])
-      freqs_bins = dict(list(data_out.items())[6:])
-
-      if resolution!=1:
-         freqs_bins['grain size bins']*=resolution
-         percentiles['percentile_values']*=resolution
-
-         for k in stats.keys():
-             stats[k] = stats[k]*resolution
-
-      S[files[counter]] = stats.items()
-      P[files[counter]] = percentiles
-      F[files[counter]] = freqs_bins
-      counter += 1
-
-   # convert into stats (rows) versus images (columns)
-   tmp = list(S.keys())
-   d = {tmp[0]: [k[1] for k in list(S[tmp[0]])]}
-   for k in range(1,len(tmp)):
-       d.update( {tmp[k]: [k[1] for k in list(S[tmp[k]])]} )
+def pick_images():
+   """
+   asks for image files in a dialog (needs a display)
+   """
+   from tkinter import Tk
+   from tkinter.filedialog import askopenfilename
+   Tk().withdraw() # we don't want a full GUI, so keep the root window from appearing
+   return list(askopenfilename(title='Select image files', multiple=True, filetypes=[("Pick files","*.*")]))
 
+#================================================================
+def do_dgs(resolution, maxscale, x, verbose, files, f, workers=None, fmt='csv', outdir='demo_results', checkpoint=None):
+   """
+   analyses files and writes the results to outdir, returning a summary
+   dict (images, analysed, resumed, failed, seconds, images per second).
+   With checkpoint (a folder), each result is stored there as soon as it
+   is computed, and a rerun skips the images already stored
+   """
+   os.makedirs(outdir, exist_ok=True)
    timestr = datetime.now().strftime("%Y-%m-%d-%H-%M")
+   start = time.perf_counter()
+
+   if checkpoint:
+      # a checkpoint only holds results for one set of parameters
+      params = {'maxscale': int(maxscale), 'x': float(x), 'f': int(f), 'version': __version__}
+      os.makedirs(checkpoint, exist_ok=True)
+      pfile = os.path.join(checkpoint, 'params.json')
+      if os.path.exists(pfile):
+         with open(pfile) as fid:
+            used = json.load(fid)
+         if used != params:
+            raise ValueError('checkpoint '+checkpoint+' was made with different parameters: '+str(used))
+      else:
+         with open(pfile, 'w') as fid:
+            json.dump(params, fid)
+
+      store = ResultStore(checkpoint)
+      resumed = len(store.done() & set(files))
+      failed = [image for image, res, err in dgs_stream(files, store, 1, maxscale, verbose, x, f, workers=workers)
+                if err is not None]
+      wanted = set(files)
+      stored = {image: res for image, res in store if image in wanted}
+      ALL_RES = [stored.get(file) for file in files]
+   else:
+      # images are processed in parallel; failed images come back as None
+      resumed = 0
+      ALL_RES = dgs_batch(files, 1, maxscale, verbose, x, f, workers=workers)
+      failed = [file for file, data_out in zip(files, ALL_RES) if data_out is None]
+
+   seconds = time.perf_counter() - start
+   summary = {'images': len(files), 'analysed': len(files) - resumed - len(failed), 'resumed': resumed,
+              'failed': len(failed), 'seconds': seconds, 'images per second': (len(files) - resumed - len(failed))/max(seconds, 1e-9)}
+   if failed:
+      with open(os.path.join(outdir, 'failed_'+timestr+'.txt'), 'w') as fid:
+         fid.write('\n'.join(failed)+'\n')
+
+   files = [file for file, data_out in zip(files, ALL_RES) if data_out is not None]
+   ALL_RES = [data_out for data_out in ALL_RES if data_out is not None]
+   if not ALL_RES:
+      return summary
+
+   ## all statistics at once, in the units of resolution (skewness and kurtosis are dimensionless)
+   freqs, bins, mask = pad_distributions(ALL_RES)
+   res = grain_size_stats(freqs, bins, mask, resolution)
+   names = ['mean grain size', 'grain size sorting', 'grain size skewness', 'grain size kurtosis']
+
+   if fmt=='npy':
+      # binary columnar result set, read back with load_results
+      save_results(outdir+os.sep+'results_batch_'+timestr, files, res, mask)
+   else:
+      # stats (rows) versus images (columns)
+      pd.DataFrame(data=np.array([res[k] for k in names]), index=names, columns=files).to_csv(outdir+os.sep+'stats_batch_'+timestr+'.csv')
 
-   pd.DataFrame(data=d, index = ['mean grain size', 'grain size sorting', 'grain size skewness', 'grain size kurtosis']).to_csv('demo_results/stats_batch_'+timestr+'.csv')
-
-   # convert into percentiles (rows) versus images (columns)
-   tmp = list(P.keys())
-   d = {tmp[0]: P[tmp[0]]['percentile_values']}
-   for k in range(1,len(tmp)):
-       d.update( {tmp[k]: P[tmp[k]]['percentile_values'] } )
-
-   pd.DataFrame(data=d, index = P[tmp[0]]['percentiles']).to_csv('demo_results/percentiles_batch_'+timestr+'.csv')
-
-   # write each to csv file
-   # pd.DataFrame.from_dict(S).to_csv('demo_results/stats_batch.csv')
-   # pd.DataFrame.from_dict(P).to_csv('demo_results/percentiles_batch.csv')
-   pd.DataFrame.from_dict(F).to_csv('demo_results/freqs_bins_batch_'+timestr+'.csv')
-
-   counter = 0
-   cols = ['r','g','b','m','c','k','y'][:len(F)]
-   for f in F:
-      try:
-         plt.plot(F[f]['grain size bins'], F[f]['grain size frequencies'],cols[counter], lw=2, label=files[counter].split(os.sep)[-1])
-      except:
-         pass
-      counter += 1
+      # percentiles (rows) versus images (columns)
+      pd.DataFrame(data=res['percentile_values'].T, index=res['percentiles'], columns=files).to_csv(outdir+os.sep+'percentiles_batch_'+timestr+'.csv')
+
+      # write each to csv file
+      F = {file: {'grain size frequencies': res['grain size frequencies'][k][mask[k]], 'grain size bins': res['grain size bins'][k][mask[k]]}
+           for k, file in enumerate(files)}
+      pd.DataFrame.from_dict(F).to_csv(outdir+os.sep+'freqs_bins_batch_'+timestr+'.csv')
+
+   cols = ['r','g','b','m','c','k','y'][:len(files)]
+   for counter in range(len(cols)):
+      plt.plot(res['grain size bins'][counter][mask[counter]], res['grain size frequencies'][counter][mask[counter]], cols[counter], lw=2, label=files[counter].split(os.sep)[-1])
    plt.legend(fontsize=6)
 
    if resolution!=1:
@@ -101,71 +154,91 @@ def do_dgs(resolution, maxscale, x, verbose, files, f):
    #plt.xlabel('Grain Size (pixels)')
    plt.ylabel('Frequency')
    #plt.show()
-   plt.savefig('demo_results/batch_psd_'+timestr+'.png', dpi=300, bbox_inches='tight')
+   plt.savefig(outdir+os.sep+'batch_psd_'+timestr+'.png', dpi=300, bbox_inches='tight')
    plt.close('all')
+   return summary
+
+#================================================================
+def usage():
+   print('======================================')
+   print('python run_dgs.py {options} {images, folders or glob patterns}')
+   print('python run_dgs.py {-r resolution in mm per pixel (float)} {-m maxscale *see below (integer)} {-x "x" parameter **see below (float) } {-f filter (0 or 1)} {-w number of parallel workers (integer)} {-o output format (csv or npy)} {-d output folder} {-l manifest file (one image per line)} {-c checkpoint folder, to resume an interrupted run} {-s shard to run, as index/shards (e.g. 3/16)} {-j merge the shards in the output folder}')
+   print('*the maximum scale (grain size) considered by the wavelet is the horizontal width dimension divided by this number')
+   print('so if your image is 2000 pixels wide and maxscale=8, only grains up to 2000/8 = 250 pixels are considered')
+   print('**this is the area to volume conversion coefficient. See Cuttler et al (provided)')
+   print('you could also use it as an empirical tuning coefficient against field data (recommended)')
+   print('folders are searched recursively for images; with no images, folders or manifest, a file dialog opens')
+   print('with -s, each shard of a batch is given the same images and output folder (on any machine sharing it); -j then merges them')
+   print('======================================')
 
 #====================================
 if __name__ == '__main__':
 
     argv = sys.argv[1:]
     try:
-        opts, args = getopt.getopt(argv,"h:r:m:x:f:")
+        opts, args = getopt.gnu_getopt(argv,"h:r:m:x:f:w:o:d:l:c:s:j")
     except getopt.GetoptError:
-        print('======================================')
-        print('python run_dgs.py') #
-        print('python run_dgs.py {-r resolution in mm per pixel (float)} {-m maxscale *see below (integer)} {-x "x" parameter **see below (float) }') #
-        print('*the maximum scale (grain size) considered by the wavelet is the horizontal width dimension divided by this number') #
-        print('so if your image is 2000 pixels wide and maxscale=8, only grains up to 2000/8 = 250 pixels are considered')
-        print('**this is the area to volume conversion coefficient. See Cuttler et al (provided)')
-        print('you could also use it as an empirical tuning coefficient against field data (recommended)')
-        print('======================================')
-
+        usage()
         sys.exit(2)
+
+    resolution = None; maxscale = None; x = None; f = None
+    workers = None; fmt = 'csv'; outdir = 'demo_results'; manifest = None; checkpoint = None
+    shard = None; merge = False
     for opt, arg in opts:
         if opt == '-h':
-            print('======================================')
-            print('python run_dgs.py') #
-            print('python run_dgs.py {-r resolution in mm per pixel (float)} {-m maxscale *see below (integer)} {-x "x" parameter **see below (float) }') #
-            print('*the maximum scale (grain size) considered by the wavelet is the horizontal width dimension divided by this number') #
-            print('so if your image is 2000 pixels wide and maxscale=8, only grains up to 2000/8 = 250 pixels are considered')
-            print('**this is the area to volume conversion coefficient. See Cuttler et al (provided)')
-            print('you could also use it as an empirical tuning coefficient against field data (recommended)')
-            print('======================================')
+            usage()
             print('======================================')
             print('Example usage: python run_dgs.py -r 0.04 -f 0')
             print('Example usage: python run_dgs.py -m 20')
             print('Example usage: python run_dgs.py -r 0.04 -m 10 -x 0.5')
             print('Example usage: python run_dgs.py -r 0.04 -m 20 -x -0.1 -f 1')
             print('Example usage: python run_dgs.py -x -0.5')
+            print('Example usage: python run_dgs.py -m 10 -w 8')
+            print('Example usage: python run_dgs.py -m 10 -o npy')
+            print('Example usage: python run_dgs.py -m 10 -d results -c results/checkpoint "surveys/**/*.JPG"')
+            print('Example usage: python run_dgs.py -m 10 -w 16 -l manifest.txt')
+            print('Example usage: python run_dgs.py -m 10 -d shards -l manifest.txt -s 3/16')
+            print('Example usage: python run_dgs.py -r 0.04 -d shards -l manifest.txt -j')
             print('======================================')
             sys.exit()
         elif opt in ("-r"):
-            resolution = arg
-            resolution = float(resolution)
+            resolution = float(arg)
         elif opt in ("-m"):
-            maxscale = arg
-            maxscale = int(maxscale)
+            maxscale = int(arg)
         elif opt in ("-x"):
-            x = arg
-            x = float(x)
+            x = float(arg)
         elif opt in ("-f"):
-            f = arg
-            f = int(f)
-
-    print(f)
-
-    if 'resolution' not in locals():
+            f = int(arg)
+        elif opt in ("-w"):
+            workers = int(arg)
+        elif opt in ("-o"):
+            fmt = arg
+        elif opt in ("-d"):
+            outdir = arg
+        elif opt in ("-l"):
+            manifest = arg
+        elif opt in ("-c"):
+            checkpoint = arg
+        elif opt in ("-s"):
+            shard = [int(a) for a in arg.split('/')]
+        elif opt in ("-j"):
+            merge = True
+
+    if resolution is None:
         resolution = 1
         print('Warning: no resolution in mm/px specified, using %i by default' % (resolution))
-    if 'maxscale' not in locals():
+    if maxscale is None:
         maxscale = 5
         print('Warning: specify a maxscale for best results, using %i by default' % (maxscale))
-    if 'x' not in locals():
+    if x is None:
         x = 0.0
         print('Warning: specify "x" for best results, using %f by default' % (x))
-    if 'f' not in locals():
+    if f is None:
         f = 0
         print('Warning: no filter specified. Using filter = {} by default'.format(f))
+    if fmt not in ('csv', 'npy'):
+        print('Output format must be csv or npy. Using csv')
+        fmt = 'csv'
 
     if f>1:
         f = 0
@@ -175,33 +248,47 @@ if __name__ == '__main__':
         f = 0
         print("Filter is 0 for False and 1 for True. Setting to False")
 
-    Tk().withdraw() # we don't want a full GUI, so keep the root window from appearing
-    files = askopenfilename(title='Select image files', multiple=True, filetypes=[("Pick files","*.*")])
+    if merge:
+        # combine the shards in outdir, checking against the images if given
+        files = find_images(args, manifest) if args or manifest else None
+        report = merge_shards(outdir, outdir+os.sep+'results_merged', files, resolution)
+        print('%i images merged from %i of %i shards into %s' % (report['images'], len(report['found']), report['shards'], outdir+os.sep+'results_merged'))
+        for key in ('missing shards', 'incomplete shards', 'duplicates', 'failed', 'missing'):
+            if report[key]:
+                print('%i %s (listed in merge.json)' % (len(report[key]), key))
+        sys.exit(1 if any(report[key] for key in ('missing shards', 'incomplete shards', 'failed', 'missing')) else 0)
+
+    if args or manifest:
+        files = find_images(args, manifest)
+    else:
+        files = pick_images()
 
     # use verbose=1 for more output from dgs
     verbose=0
 
-    # exit program if no input folder given
+    # exit program if no input images given
     if not files:
        print('Image files are required! ... program exiting')
        sys.exit(2)
 
-    if resolution:
-       resolution = np.asarray(resolution,float)
-       print('Resolution is '+str(resolution))
-
-    if maxscale:
-       maxscale = np.asarray(maxscale,int)
-       print('Max scale as inverse fraction of data length: '+str(maxscale))
+    print('Resolution is '+str(resolution))
+    print('Max scale as inverse fraction of data length: '+str(maxscale))
+    print('Area to volume conversion constant = '+str(x))
+    print('Filter = '+str(f))
+    print(str(len(files))+' images')
 
-    if x:
-       x = np.asarray(x, float)
-       print('Area to volume conversion constant = '+str(x))
-
-    if f:
-       f = np.asarray(f, int)
-       print('Filter = '+str(f))
+    if shard:
+        # results stay in pixels; -r is applied when the shards are merged
+        info = dgs_shard(files, outdir, shard[0], shard[1], 1, maxscale, verbose, x, f, workers=workers)
+        print('======================================')
+        print('shard %i of %i: %i images, %i failed' % (shard[0], shard[1], len(info['images']), len(info['failed'])))
+        sys.exit(1 if info['failed'] else 0)
 
-    do_dgs(resolution, maxscale, x, verbose, files, f)
+    summary = do_dgs(resolution, maxscale, x, verbose, files, f, workers, fmt, outdir, checkpoint)
 
-##
+    print('======================================')
+    print('%i images: %i analysed, %i resumed from checkpoint, %i failed' % (summary['images'], summary['analysed'], summary['resumed'], summary['failed']))
+    print('%.1f s, %.2f images/s' % (summary['seconds'], summary['images per second']))
+    if summary['failed']:
+        print('Failed images are listed in '+outdir)
+        sys.exit(1)
@@ -50,6 +50,7 @@ def dotest1(image, with_plot=False):
    filter = 0
 
    #I recommend you compute in pixels (resolution=1) then apply your resolution scaling afterwards
+   # (dgs applies resolution itself, so the results are not rescaled again here)
    data_out = dgs(image, resolution, maxscale, verbose, x, filter)
 
    ## parse out dict into three separate dictionaries
@@ -57,13 +58,6 @@ def dotest1(image, with_plot=False):
    percentiles = dict(list(data_out.items())[4:6])
    freqs_bins = dict(list(data_out.items())[6:])
 
-   if resolution!=1:
-       freqs_bins['grain size bins']*=resolution
-       percentiles['percentile_values']*=resolution
-
-       for k in stats.keys():
-           stats[k] = stats[k]*resolution
-
    # write each to csv file
    pd.DataFrame.from_dict(stats.items()).to_csv('demo_results/'+image.split(os.sep)[-1]+'_stats.csv')
    pd.DataFrame.from_dict(percentiles).to_csv('demo_results/'+image.split(os.sep)[-1]+'_percentiles.csv')
@@ -85,7 +79,7 @@ def dotest1(image, with_plot=False):
 
 #========================================
 ## folder of images
-def dotest_batch(folder, set=1, with_plot=False):
+def dotest_batch(folder, set=1, with_plot=False, fmt='csv'):
 
    if set==1:
       files = glob.glob(folder+os.sep+'IMG*.JPG')
@@ -118,59 +112,36 @@ def dotest_batch(folder, set=1, with_plot=False):
    # 1 means apply denoising filter
    filter = 1
 
-   ALL_RES = []
-   for f in tqdm(files): #tqdm gives you a progress bar
-      data_out = dgs(f, resolution, maxscale, verbose, x, filter)
-      ALL_RES.append(data_out)
-
-
-   ## parse out dict into three separate dictionaries
-   S = {}; P = {}; F = {}
-   counter = 0
-   for data_out in ALL_RES:
-      stats = dict(list(data_out.items())[:4])
-      percentiles = dict(list(data_out.items())[4:6])
-      freqs_bins = dict(list(data_out.items())[6:])
-
-      if resolution!=1:
-         freqs_bins['grain size bins']*=resolution
-         percentiles['percentile_values']*=resolution
-
-         for k in stats.keys():
-             stats[k] = stats[k]*resolution
-
-      S[files[counter]] = stats.items()
-      P[files[counter]] = percentiles
-      F[files[counter]] = freqs_bins
-      counter += 1
+   # images are processed in parallel; failed images come back as None.
+   # results are in pixels, and resolution is applied below
+   ALL_RES = dgs_batch(files, 1, maxscale, verbose, x, filter)
+   files = [f for f, data_out in zip(files, ALL_RES) if data_out is not None]
+   ALL_RES = [data_out for data_out in ALL_RES if data_out is not None]
 
-   # convert into stats (rows) versus images (columns)
-   tmp = list(S.keys())
-   d = {tmp[0]: [k[1] for k in list(S[tmp[0]])]}
-   for k in range(1,len(tmp)):
-       d.update( {tmp[k]: [k[1] for k in list(S[tmp[k]])]} )
+   ## all statistics at once, in the units of resolution (skewness and kurtosis are dimensionless)
+   freqs, bins, mask = pad_distributions(ALL_RES)
+   res = grain_size_stats(freqs, bins, mask, resolution)
+   names = ['mean grain size', 'grain size sorting', 'grain size skewness', 'grain size kurtosis']
 
-   pd.DataFrame(data=d, index = ['mean grain size', 'grain size sorting', 'grain size skewness', 'grain size kurtosis']).to_csv('demo_results/stats_batch.csv')
+   if fmt=='npy':
+      # binary columnar result set, read back with load_results
+      save_results('demo_results/results_batch', files, res, mask)
+   else:
+      # stats (rows) versus images (columns)
+      pd.DataFrame(data=np.array([res[k] for k in names]), index=names, columns=files).to_csv('demo_results/stats_batch.csv')
 
-   # convert into percentiles (rows) versus images (columns)
-   tmp = list(P.keys())
-   d = {tmp[0]: P[tmp[0]]['percentile_values']}
-   for k in range(1,len(tmp)):
-       d.update( {tmp[k]: P[tmp[k]]['percentile_values'] } )
+      # percentiles (rows) versus images (columns)
+      pd.DataFrame(data=res['percentile_values'].T, index=res['percentiles'], columns=files).to_csv('demo_results/percentiles_batch.csv')
 
-   pd.DataFrame(data=d, index = P[tmp[0]]['percentiles']).to_csv('demo_results/percentiles_batch.csv')
-
-   # write each to csv file
-   # pd.DataFrame.from_dict(S).to_csv('demo_results/stats_batch.csv')
-   # pd.DataFrame.from_dict(P).to_csv('demo_results/percentiles_batch.csv')
-   pd.DataFrame.from_dict(F).to_csv('demo_results/freqs_bins_batch.csv')
+      # write each to csv file
+      F = {file: {'grain size frequencies': res['grain size frequencies'][k][mask[k]], 'grain size bins': res['grain size bins'][k][mask[k]]}
+           for k, file in enumerate(files)}
+      pd.DataFrame.from_dict(F).to_csv('demo_results/freqs_bins_batch.csv')
 
    if with_plot == True:
-       counter = 0
-       cols = ['r','g','b','m','c','k','y'][:len(F)]
-       for f in F:
-          plt.plot(F[f]['grain size bins'], F[f]['grain size frequencies'],cols[counter], lw=2, label=files[counter])
-          counter += 1
+       cols = ['r','g','b','m','c','k','y'][:len(files)]
+       for counter in range(len(cols)):
+          plt.plot(res['grain size bins'][counter][mask[counter]], res['grain size frequencies'][counter][mask[counter]], cols[counter], lw=2, label=files[counter])
        plt.legend()
 
        if resolution!=1: